@@ -0,0 +1,305 @@
+"""Micro-benchmarks of MDMModel on synthetic, on-device data.
+
+    python benchmark.py --benchmark=xla --device=/cpu:0 --batch_size=30
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import numpy as np
+import tensorflow as tf
+import time
+
+import data_provider
+import mdm_model
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_string('benchmark', 'xla', """Benchmark to run.""")
+tf.flags.DEFINE_string('device', '/cpu:0', """Device the model is placed on.""")
+tf.flags.DEFINE_integer('batch_size', 30, """Train batch size.""")
+tf.flags.DEFINE_integer('num_patches', 75, """Number of landmarks.""")
+tf.flags.DEFINE_integer('image_size', 112, """Input image side length.""")
+tf.flags.DEFINE_float('multiplier', 1.0, """Model width multiplier.""")
+tf.flags.DEFINE_integer('num_warmup', 10, """Untimed steps before measuring.""")
+tf.flags.DEFINE_integer('num_steps', 50, """Timed steps.""")
+tf.flags.DEFINE_integer('memory_budget_mb', 4096, """Memory budget used to report the largest batch size.""")
+tf.flags.DEFINE_float('bfloat16_tolerance', 1.0, """Largest mean bfloat16 prediction difference, in pixels.""")
+
+
+def build_train_step(images, shapes, mean_shape, batch_size, num_patches, multiplier, **kwargs):
+    """The train step of mdm_train: forward, backward, Adam and batch norm updates."""
+    model = mdm_model.MDMModel(
+        images, shapes, mean_shape,
+        batch_size=batch_size,
+        num_patches=num_patches,
+        num_channels=3,
+        multiplier=multiplier,
+        **kwargs
+    )
+    global_step = tf.train.get_or_create_global_step()
+    opt = tf.train.AdamOptimizer(1e-3)
+    with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+        train_op = opt.minimize(model.nme, global_step=global_step)
+    return train_op
+
+
+def build_inference(images, shapes, mean_shape, batch_size, num_patches, multiplier, **kwargs):
+    model = mdm_model.MDMModel(
+        images, None, mean_shape,
+        batch_size=batch_size,
+        num_patches=num_patches,
+        num_channels=3,
+        multiplier=multiplier,
+        is_training=False,
+        inference_only=True,
+        **kwargs
+    )
+    return model.prediction
+
+
+def peak_bytes(run_metadata):
+    """Largest allocator peak reported in a FULL_TRACE run."""
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for memory in dev_stats.memory:
+            peak = max(peak, memory.peak_bytes)
+    return peak
+
+
+def time_fetch(build_fn, num_warmup, num_steps, device='/cpu:0', config=None):
+    """Build a graph with `build_fn` and time `sess.run` of what it returns.
+    Returns:
+        dict with mean/p50/p90 milliseconds per run and peak allocator bytes.
+    """
+    with tf.Graph().as_default() as graph, tf.device(device):
+        fetch = build_fn()
+        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+        with tf.Session(graph=graph, config=config) as sess:
+            sess.run(init)
+            for _ in range(num_warmup):
+                sess.run(fetch)
+            durations = []
+            for _ in range(num_steps):
+                start_time = time.time()
+                sess.run(fetch)
+                durations.append(time.time() - start_time)
+            run_metadata = tf.RunMetadata()
+            sess.run(
+                fetch,
+                options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                run_metadata=run_metadata
+            )
+    durations = np.array(durations) * 1000.
+    return {
+        'mean_ms': float(np.mean(durations)),
+        'p50_ms': float(np.percentile(durations, 50)),
+        'p90_ms': float(np.percentile(durations, 90)),
+        'peak_bytes': int(peak_bytes(run_metadata)),
+    }
+
+
+def compare_models(variants, image_size=None):
+    """Time the train step and batch-1 inference for each variant of MDMModel.
+    Args:
+        variants: list of dicts of extra MDMModel keyword arguments.
+        image_size: input side length, defaults to the image_size flag.
+    Returns:
+        list of result dicts, one per variant and graph.
+    """
+    results = []
+    for kwargs in variants:
+        for name, build, batch_size in (
+                ('train', build_train_step, FLAGS.batch_size),
+                ('inference', build_inference, 1)
+        ):
+            def build_fn():
+                images, shapes, mean_shape = data_provider.synthetic_batch(
+                    batch_size, FLAGS.num_patches, image_size or FLAGS.image_size
+                )
+                return build(
+                    images, shapes, mean_shape, batch_size, FLAGS.num_patches, FLAGS.multiplier,
+                    **kwargs
+                )
+            result = time_fetch(build_fn, FLAGS.num_warmup, FLAGS.num_steps, FLAGS.device)
+            result.update(kwargs)
+            result.update({'graph': name, 'batch_size': batch_size})
+            results.append(result)
+    return results
+
+
+def benchmark_xla():
+    """Default executor against XLA JIT."""
+    return compare_models([{'use_xla': False}, {'use_xla': True}])
+
+
+def check_bfloat16(device='/cpu:0'):
+    """Run one bfloat16 train step and inference on `device` and compare the
+    predictions with float32 on the same weights. Builds without bfloat16 conv
+    or depthwise kernels, like stock TF1 CPU builds, report the error instead.
+    """
+    result = {'check': 'bfloat16', 'device': device}
+    try:
+        with tf.Graph().as_default() as graph, tf.device(device):
+            images, shapes, mean_shape = data_provider.synthetic_batch(
+                FLAGS.batch_size, FLAGS.num_patches, FLAGS.image_size
+            )
+            predictions = [
+                build_inference(
+                    images, shapes, mean_shape, FLAGS.batch_size, FLAGS.num_patches, FLAGS.multiplier,
+                    dtype=dtype
+                )
+                for dtype in ('float32', 'bfloat16')
+            ]
+            train_op = build_train_step(
+                images, shapes, mean_shape, FLAGS.batch_size, FLAGS.num_patches, FLAGS.multiplier,
+                dtype='bfloat16'
+            )
+            with tf.Session(graph=graph) as sess:
+                sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+                float32, bfloat16 = sess.run(predictions)
+                sess.run(train_op)
+    except (tf.errors.NotFoundError, tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+        result.update({'runs': False, 'error': e.message})
+        return result
+    difference = np.abs(float32 - bfloat16)
+    result.update({
+        'runs': True,
+        'max_abs_difference': float(np.max(difference)),
+        'mean_abs_difference': float(np.mean(difference)),
+        'within_tolerance': bool(np.mean(difference) <= FLAGS.bfloat16_tolerance),
+    })
+    return result
+
+
+def benchmark_precision():
+    """float32 against bfloat16 activations; bfloat16 is only timed if it runs and matches."""
+    check = check_bfloat16(FLAGS.device)
+    dtypes = ['float32', 'bfloat16'] if check['runs'] and check['within_tolerance'] else ['float32']
+    return [check] + compare_models([{'dtype': dtype} for dtype in dtypes])
+
+
+def check_recompute_gradients():
+    """Check that every trainable variable gets a gradient with recompute."""
+    with tf.Graph().as_default(), tf.device(FLAGS.device):
+        images, shapes, mean_shape = data_provider.synthetic_batch(
+            FLAGS.batch_size, FLAGS.num_patches, FLAGS.image_size
+        )
+        model = mdm_model.MDMModel(
+            images, shapes, mean_shape,
+            batch_size=FLAGS.batch_size,
+            num_patches=FLAGS.num_patches,
+            num_channels=3,
+            multiplier=FLAGS.multiplier,
+            recompute=True
+        )
+        var_list = tf.trainable_variables()
+        grads = tf.gradients(model.nme, var_list)
+    missing = [var.op.name for var, grad in zip(var_list, grads) if grad is None]
+    return {'check': 'recompute_gradients', 'variables': len(var_list), 'missing': missing, 'ok': not missing}
+
+
+def benchmark_recompute():
+    """Train step with and without activation recomputation, after checking the
+    recomputed blocks still get gradients.
+    Peak memory is measured at batch_size and 2 * batch_size and extrapolated
+    linearly to the largest batch size that fits in memory_budget_mb.
+    """
+    results = [check_recompute_gradients()]
+    if not results[0]['ok']:
+        return results
+    for recompute in (False, True):
+        peaks = []
+        for batch_size in (FLAGS.batch_size, 2 * FLAGS.batch_size):
+            def build_fn():
+                images, shapes, mean_shape = data_provider.synthetic_batch(
+                    batch_size, FLAGS.num_patches, FLAGS.image_size
+                )
+                return build_train_step(
+                    images, shapes, mean_shape, batch_size, FLAGS.num_patches, FLAGS.multiplier,
+                    recompute=recompute
+                )
+            result = time_fetch(build_fn, FLAGS.num_warmup, FLAGS.num_steps, FLAGS.device)
+            result.update({'graph': 'train', 'recompute': recompute, 'batch_size': batch_size})
+            results.append(result)
+            peaks.append(result['peak_bytes'])
+        bytes_per_example = max(peaks[1] - peaks[0], 1) / FLAGS.batch_size
+        fixed_bytes = peaks[0] - bytes_per_example * FLAGS.batch_size
+        max_batch_size = int((FLAGS.memory_budget_mb * 2 ** 20 - fixed_bytes) // bytes_per_example)
+        results.append({
+            'recompute': recompute,
+            'bytes_per_example': int(bytes_per_example),
+            'max_batch_size': max_batch_size,
+            'memory_budget_mb': FLAGS.memory_budget_mb,
+        })
+    return results
+
+
+def benchmark_channel_shuffle():
+    """Split/concat channel shuffle against the lazy one. Both models share
+    weights in one graph to check that their predictions are identical."""
+    with tf.Graph().as_default() as graph, tf.device(FLAGS.device):
+        images, shapes, mean_shape = data_provider.synthetic_batch(
+            FLAGS.batch_size, FLAGS.num_patches, FLAGS.image_size
+        )
+        predictions = [
+            build_inference(
+                images, shapes, mean_shape, FLAGS.batch_size, FLAGS.num_patches, FLAGS.multiplier,
+                channel_shuffle=channel_shuffle
+            )
+            for channel_shuffle in ('split', 'lazy')
+        ]
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+            split, lazy = sess.run(predictions)
+    results = compare_models([{'channel_shuffle': 'split'}, {'channel_shuffle': 'lazy'}])
+    results.append({'max_abs_difference': float(np.max(np.abs(split - lazy)))})
+    return results
+
+
+def benchmark_data_format():
+    """NHWC against NCHW. Builds without channels-first CPU kernels (non-MKL)
+    report the error instead of timings."""
+    results = []
+    for data_format in ('channels_last', 'channels_first'):
+        try:
+            results.extend(compare_models([{'data_format': data_format}]))
+        except (tf.errors.UnimplementedError, tf.errors.InvalidArgumentError) as e:
+            results.append({'data_format': data_format, 'error': e.message})
+    return results
+
+
+def benchmark_refine():
+    """Cost of 0 to 3 feature-level refinement iterations."""
+    return compare_models([{'refine_iterations': n} for n in range(4)])
+
+
+def benchmark_image_size():
+    """Cost of the 64, 80 and 96 pixel low-latency tiers against 112."""
+    results = []
+    for image_size in (64, 80, 96, 112):
+        for result in compare_models([{}], image_size):
+            result['image_size'] = image_size
+            results.append(result)
+    return results
+
+
+_BENCHMARKS = {
+    'xla': benchmark_xla,
+    'precision': benchmark_precision,
+    'recompute': benchmark_recompute,
+    'channel_shuffle': benchmark_channel_shuffle,
+    'data_format': benchmark_data_format,
+    'refine': benchmark_refine,
+    'image_size': benchmark_image_size,
+}
+
+
+def main(_):
+    results = _BENCHMARKS[FLAGS.benchmark]()
+    for result in results:
+        print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == '__main__':
+    tf.app.run()
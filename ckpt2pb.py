@@ -4,55 +4,132 @@ from pathlib import Path
 import tensorflow as tf
 
 import data_provider
+import graph_optimizer
 import mdm_model
 import utils
 
 g_config = utils.load_config()
 
 
+_EARLY_EXIT_OUTPUTS = ['Network/EarlyExit/Prediction', 'Network/EarlyExit/ExitIndex']
+
+
+def output_name(model_config=None):
+    """Landmark output of the exported graph."""
+    model_config = model_config or g_config
+    return 'Network/Refine/Prediction' if model_config['refine_iterations'] > 0 else 'Network/Predict/add'
+
+
+def _build(mean_shape, model_config, folded=False, early_exit=False):
+    image_size = model_config['image_size']
+    tf_img = tf.placeholder(dtype=tf.float32, shape=(1, image_size, image_size, 3), name='Inputs/InputImage')
+    tf_shape = tf.constant(
+        mean_shape, dtype=tf.float32, shape=(model_config['num_patches'], 2), name='Inputs/MeanShape'
+    )
+    model = mdm_model.MDMModel(
+        tf_img,
+        None,
+        tf_shape,
+        batch_size=1,
+        is_training=False,
+        inference_only=True,
+        folded=folded,
+        **mdm_model.config_kwargs(model_config)
+    )
+    if early_exit:
+        model.attach_early_exit(tf.placeholder_with_default(
+            tf.constant(model_config['exit_threshold'], tf.float32), [], name='Inputs/ExitThreshold'
+        ))
+    return model
+
+
+def load_mean_shape(image_size=None):
+    path_base = Path(g_config['eval_dataset']).parent.parent
+    _mean_shape = mio.import_pickle(path_base / 'mean_shape.pkl')
+    _mean_shape = data_provider.align_reference_shape_to_size(
+        _mean_shape, image_size or g_config['image_size']
+    )
+    assert isinstance(_mean_shape, np.ndarray)
+    return _mean_shape
+
+
+def freeze_checkpoint(checkpoint_path, mean_shape, model_config=None, config=None, early_exit=False,
+                      tolerance=1e-2):
+    """Freeze a checkpoint, as is and with batch norms and the mean shape folded in.
+    Args:
+        checkpoint_path: checkpoint to restore.
+        mean_shape: [num_patches, 2] mean shape aligned to the image size.
+        model_config: config with the model keys, defaults to config.json.
+        early_exit: freeze the per-request early-exit graph, with the optional
+            input `Inputs/ExitThreshold` and the outputs `Network/EarlyExit/Prediction`
+            and `Network/EarlyExit/ExitIndex`.
+        tolerance: largest absolute output difference, in pixels, allowed between
+            the frozen and the optimized graph on the same input.
+    Returns:
+        (frozen graph def, optimized graph def), both with input `Inputs/InputImage`
+        and output `output_name(model_config)` unless `early_exit`
+    """
+    model_config = model_config or g_config
+    config = config or utils.session_config()
+    output_names = _EARLY_EXIT_OUTPUTS if early_exit else [output_name(model_config)]
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph, config=config) as sess:
+        _build(mean_shape, model_config, early_exit=early_exit)
+        tf.train.Saver().restore(sess, checkpoint_path)
+        frozen_graph_def = graph_optimizer.freeze(sess, output_names)
+        values = graph_optimizer.read_variables(sess)
+
+    # fold batch norms and the mean shape into the conv weights
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph, config=config) as sess:
+        _build(mean_shape, model_config, folded=True, early_exit=early_exit)
+        graph_optimizer.load_variables(sess, graph_optimizer.fold_batch_norms(values, mean_shape))
+        # The tf.cond pivots of the early-exit graph are Identity nodes, keep them.
+        output_graph_def = graph_optimizer.freeze(sess, output_names, optimize=not early_exit)
+
+    difference = graph_optimizer.max_output_difference(
+        [frozen_graph_def, output_graph_def], 'Inputs/InputImage', output_names, config=config
+    )
+    if difference > tolerance:
+        raise ValueError('Folded graph outputs differ from the checkpoint by {:.6f} > {}'.format(
+            difference, tolerance
+        ))
+    return frozen_graph_def, output_graph_def
+
+
 def ckpt_pb(pb_path, lite_path):
-    config = tf.ConfigProto(allow_soft_placement=True)
-    config.gpu_options.allow_growth = True
+    config = utils.session_config()
+    _mean_shape = load_mean_shape()
+    print(_mean_shape.shape)
     # to pb
     tf.reset_default_graph()
-    with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
-        path_base = Path(g_config['eval_dataset']).parent.parent
-        _mean_shape = mio.import_pickle(path_base / 'mean_shape.pkl')
-        _mean_shape = data_provider.align_reference_shape_to_112(_mean_shape)
-        assert isinstance(_mean_shape, np.ndarray)
-        print(_mean_shape.shape)
-
-        tf_img = tf.placeholder(dtype=tf.float32, shape=(1, 112, 112, 3), name='Inputs/InputImage')
-        tf_dummy = tf.placeholder(dtype=tf.float32, shape=(1, 75, 2), name='dummy')
-        tf_shape = tf.constant(_mean_shape, dtype=tf.float32, shape=(75, 2), name='Inputs/MeanShape')
-
-        mdm_model.MDMModel(
-            tf_img,
-            tf_dummy,
-            tf_shape,
-            batch_size=1,
-            num_patches=g_config['num_patches'],
-            num_channels=3,
-            multiplier=g_config['multiplier'],
-            is_training=False
+    ckpt = tf.train.get_checkpoint_state(g_config['train_dir'])
+    if ckpt and ckpt.model_checkpoint_path:
+        frozen_graph_def, output_graph_def = freeze_checkpoint(
+            ckpt.model_checkpoint_path, _mean_shape, config=config
         )
+        global_step = ckpt.model_checkpoint_path.split('/')[-1].split('-')[-1]
+        print('Successfully loaded model from {} at step={}.'.format(ckpt.model_checkpoint_path, global_step))
+    else:
+        print('No checkpoint file found')
+        return
 
-        saver = tf.train.Saver()
-        ckpt = tf.train.get_checkpoint_state(g_config['train_dir'])
-        if ckpt and ckpt.model_checkpoint_path:
-            saver.restore(sess, ckpt.model_checkpoint_path)
-            global_step = ckpt.model_checkpoint_path.split('/')[-1].split('-')[-1]
-            print('Successfully loaded model from {} at step={}.'.format(ckpt.model_checkpoint_path, global_step))
-        else:
-            print('No checkpoint file found')
-            return
-
-        output_graph_def = tf.graph_util.convert_variables_to_constants(
-            sess, tf.get_default_graph().as_graph_def(), ['Network/Predict/add']
+    for name, graph_def in (('frozen', frozen_graph_def), ('optimized', output_graph_def)):
+        latency = graph_optimizer.measure_latency(
+            graph_def, 'Inputs/InputImage', output_name(), config=config
         )
+        print('{}: {} nodes, {:.3f} ms mean, {:.3f} ms p50'.format(
+            name, graph_optimizer.count_nodes(graph_def), latency['mean_ms'], latency['p50_ms']
+        ))
+
+    with tf.gfile.FastGFile(pb_path, mode='wb') as f:
+        f.write(output_graph_def.SerializeToString())
 
-        with tf.gfile.FastGFile(pb_path, mode='wb') as f:
-            f.write(output_graph_def.SerializeToString())
+    if g_config['exits']:
+        # TFLite has no tf.cond, so the early-exit graph is only written as a pb.
+        _, exit_graph_def = freeze_checkpoint(ckpt.model_checkpoint_path, _mean_shape, config=config, early_exit=True)
+        exit_pb_path = str(Path(pb_path).with_name(Path(pb_path).stem + '_exit.pb'))
+        with tf.gfile.FastGFile(exit_pb_path, mode='wb') as f:
+            f.write(exit_graph_def.SerializeToString())
+        print('early exit: {} nodes written to {}'.format(graph_optimizer.count_nodes(exit_graph_def), exit_pb_path))
 
     # to tflite
     tf.reset_default_graph()
@@ -73,7 +150,7 @@ def ckpt_pb(pb_path, lite_path):
         converter = tf.contrib.lite.TFLiteConverter.from_frozen_graph(
             pb_path,
             ['Inputs/InputImage'],
-            ['Network/Predict/Reshape', 'Inputs/MeanShape']
+            [output_name()]
         )
         with tf.gfile.FastGFile(lite_path, mode='wb') as f:
             f.write(converter.convert())
@@ -88,4 +165,5 @@ def ckpt_pb(pb_path, lite_path):
         print(output_details)
 
 
-ckpt_pb('shuffle.pb', 'shuffle.tflite')
+if __name__ == '__main__':
+    ckpt_pb('shuffle.pb', 'shuffle.tflite')
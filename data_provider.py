@@ -1,3 +1,5 @@
+import hashlib
+import json
 import menpo.shape as mshape
 from menpofit.builder import compute_reference_shape
 import multiprocessing
@@ -42,6 +44,40 @@ def grey_to_rgb(im):
     return im
 
 
+def load_negatives(pattern, size=112, verbose=True):
+    """Load the negative (non-face) images used for occlusion.
+    The images are packed once into a uint8 array cached next to them as
+    `negatives_<size>_<hash>.npy`, keyed on the matched file names, so a changed
+    negative set is packed again; later runs only load that file.
+    Args:
+        pattern: glob of the negative images, e.g. 'Dataset/Neg/*.png'.
+        size: side length the negatives are resized to.
+        verbose: boolean, print debugging info.
+    Returns:
+        uint8 array [N, size, size, 3]
+    """
+    # The packed caches live next to the images; a broad pattern must not hash them.
+    files = sorted(p.name for p in Path(pattern).parent.glob(Path(pattern).name) if p.suffix != '.npy')
+    if not files:
+        raise IOError('No negative images match {}; set occlusion_probability to 0 to train without'.format(
+            pattern
+        ))
+    digest = hashlib.md5('\n'.join(files).encode('utf-8')).hexdigest()[:8]
+    cache_path = Path(pattern).parent / 'negatives_{}_{}.npy'.format(size, digest)
+    if cache_path.exists():
+        return np.load(str(cache_path))
+    negatives = []
+    for mp_image in mio.import_images(pattern, verbose=verbose):
+        if mp_image.shape != (size, size):
+            mp_image = mp_image.resize((size, size))
+        mp_image = grey_to_rgb(mp_image)
+        pixels = mp_image.pixels.transpose(1, 2, 0) * 255. + .5
+        negatives.append(np.clip(pixels, 0, 255).astype(np.uint8))
+    negatives = np.stack(negatives)
+    np.save(str(cache_path), negatives)
+    return negatives
+
+
 def align_reference_shape(reference_shape, bb):
     def norm(x):
         return tf.sqrt(tf.reduce_sum(tf.square(x - tf.reduce_mean(x, 0))))
@@ -61,6 +97,11 @@ def align_reference_shape(reference_shape, bb):
 
 
 def align_reference_shape_to_112(reference_shape):
+    return align_reference_shape_to_size(reference_shape, 112)
+
+
+def align_reference_shape_to_size(reference_shape, size):
+    """Scale and center the reference shape into a size x size image."""
     assert isinstance(reference_shape, np.ndarray)
 
     def norm(x):
@@ -70,7 +111,7 @@ def align_reference_shape_to_112(reference_shape):
     min_x, min_y = min_xy[0], min_xy[1]
     max_x, max_y = max_xy[0], max_xy[1]
     reference_shape_bb = np.vstack([[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y]])
-    bb = np.vstack([[0.0, 0.0], [112.0, 0.0], [112.0, 112.0], [0.0, 112.0]])
+    bb = np.vstack([[0.0, 0.0], [size, 0.0], [size, size], [0.0, size]]).astype(np.float64)
     ratio = norm(bb) / norm(reference_shape_bb)
     reference_shape = (reference_shape - np.mean(reference_shape_bb, 0)) * ratio + np.mean(bb, 0)
     return reference_shape
@@ -121,7 +162,14 @@ def load_image(path, proportion, size):
     return mp_image
 
 
-def process_images(queue, i, augment, paths):
+def record_dir(path_base, image_size=112):
+    """Directory of the TFRecords prepared at `image_size`; 112 keeps the dataset directory."""
+    if image_size == 112:
+        return Path(path_base)
+    return Path(path_base) / 'size{}'.format(image_size)
+
+
+def process_images(queue, i, augment, paths, size=112):
     print('begin p{}'.format(i), os.getpid(), os.getppid())
     cnt = 0
     for path in paths:
@@ -182,7 +230,7 @@ def process_images(queue, i, augment, paths):
                 mp_image_i.landmarks['PTS'] = mshape.PointCloud(pad_shape)
                 mp_image_i.landmarks['bb'] = mshape.PointCloud(pad_bb).bounding_box()
                 mp_image_i = mp_image_i.crop_to_landmarks_proportion(0, group='bb')
-                mp_image_i = mp_image_i.resize((112, 112))
+                mp_image_i = mp_image_i.resize((size, size))
                 mp_image_i = grey_to_rgb(mp_image_i)
 
                 image = mp_image_i.pixels.transpose(1, 2, 0).astype(np.float32)
@@ -204,7 +252,7 @@ def process_images(queue, i, augment, paths):
     print('end p{}'.format(i), len(paths))
 
 
-def write_images(queue, i, path_base, max_to_write):
+def write_images(queue, i, path_base, max_to_write, first_id=0):
     print('begin r{}'.format(i), os.getpid(), os.getppid())
     wrote = 0
     with tf.io.TFRecordWriter(str(path_base / 'train_{}.bin'.format(i))) as ofs:
@@ -218,6 +266,9 @@ def write_images(queue, i, path_base, max_to_write):
                         ),
                         'train/shape': tf.train.Feature(
                             float_list=tf.train.FloatList(value=lms.flatten())
+                        ),
+                        'train/id': tf.train.Feature(
+                            int64_list=tf.train.Int64List(value=[first_id + wrote])
                         )
                     }
                 )
@@ -229,11 +280,12 @@ def write_images(queue, i, path_base, max_to_write):
     print('end r{}'.format(i), path_base)
 
 
-def prepare_images(paths, num_patches, verbose=True):
+def prepare_images(paths, num_patches, image_size=112, verbose=True):
     """Save Train/Test/Validate Images to TFRecord, for ShuffleNet
     Args:
         paths: a list of strings containing the data directories.
         num_patches: number of landmarks
+        image_size: side length of the saved images; the records go to `record_dir`.
         verbose: boolean, print debugging info.
     Returns:
         None
@@ -284,9 +336,12 @@ def prepare_images(paths, num_patches, verbose=True):
 
     # Fourth: image shape & pca
     # No need for ShuffleNet
+    record_base = record_dir(path_base, image_size)
+    if not record_base.exists():
+        record_base.mkdir(parents=True)
 
     # Fifth: train data
-    if Path(path_base / 'train_0.bin').exists():
+    if Path(record_base / 'train_0.bin').exists():
         pass
     else:
         print('preparing train data')
@@ -300,6 +355,7 @@ def prepare_images(paths, num_patches, verbose=True):
         message_queue = [manager.Queue(64) for _ in range(num_write)]
         calc_pool = multiprocessing.Pool(num_process)
         write_pool = multiprocessing.Pool(num_write)
+        first_id = 0
         for i in range(num_write):
             train_paths_1 = train_paths[(i * 2) * image_per_calc: (i * 2 + 1) * image_per_calc]
             train_paths_2 = train_paths[(i * 2 + 1) * image_per_calc: (i * 2 + 2) * image_per_calc]
@@ -307,29 +363,35 @@ def prepare_images(paths, num_patches, verbose=True):
                 message_queue[i],
                 i * 2, augment,
                 train_paths_1,
+                image_size,
             ))
             calc_pool.apply_async(process_images, args=(
                 message_queue[i],
                 i * 2 + 1, augment,
                 train_paths_2,
+                image_size,
             ))
             write_pool.apply_async(write_images, args=(
                 message_queue[i],
                 i,
-                path_base,
+                record_base,
                 (len(train_paths_1) + len(train_paths_2)) * augment,
+                first_id,
             ))
+            first_id += (len(train_paths_1) + len(train_paths_2)) * augment
         calc_pool.close()
         write_pool.close()
         calc_pool.join()
         write_pool.join()
+        with Path(record_base / 'train_meta.json').open('w') as ofs:
+            json.dump({'num_records': first_id}, ofs)
     print('prepared train data')
 
     # Sixth: test data
-    if Path(path_base / 'test.bin').exists():
+    if Path(record_base / 'test.bin').exists():
         pass
     else:
-        with tf.io.TFRecordWriter(str(path_base / 'test.bin')) as ofs:
+        with tf.io.TFRecordWriter(str(record_base / 'test.bin')) as ofs:
             print('Preparing test data...')
             counter = 0
             for path in test_paths:
@@ -344,9 +406,9 @@ def prepare_images(paths, num_patches, verbose=True):
                     status_str += '] {}     '.format(path)
                     print(status_str, end='')
 
-                mp_image = load_image(path, 1. / 6., 112)
+                mp_image = load_image(path, 1. / 6., image_size)
                 mp_image.landmarks['init'] = mshape.PointCloud(
-                    align_reference_shape_to_112(mean_shape.points.astype(np.float32))
+                    align_reference_shape_to_size(mean_shape.points.astype(np.float32), image_size)
                 )
 
                 image = mp_image.pixels.transpose(1, 2, 0).astype(np.float32)
@@ -371,11 +433,11 @@ def prepare_images(paths, num_patches, verbose=True):
                 print('')
 
     # Seven: validate data
-    if Path(path_base / 'validate.bin').exists():
+    if Path(record_base / 'validate.bin').exists():
         pass
     else:
         random.shuffle(val_paths)
-        with tf.io.TFRecordWriter(str(path_base / 'validate.bin')) as ofs:
+        with tf.io.TFRecordWriter(str(record_base / 'validate.bin')) as ofs:
             print('Preparing validate data...')
             counter = 0
             for path in val_paths:
@@ -390,7 +452,7 @@ def prepare_images(paths, num_patches, verbose=True):
                     status_str += '] {}     '.format(path)
                     print(status_str, end='')
 
-                mp_image = load_image(path, 1. / 6., 112)
+                mp_image = load_image(path, 1. / 6., image_size)
 
                 image = mp_image.pixels.transpose(1, 2, 0).astype(np.float32)
                 shape = mp_image.landmarks['PTS'].points.astype(np.float32)
@@ -446,3 +508,272 @@ def distort_color(image, thread_id=0, stddev=0.1):
         # The random_* ops do not necessarily clamp.
         image = tf.clip_by_value(image, 0.0, 1.0)
         return image
+
+
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+_RGB_TO_YIQ = np.array([
+    [0.299, 0.587, 0.114],
+    [0.596, -0.274, -0.322],
+    [0.211, -0.523, 0.312]
+], dtype=np.float32)
+_YIQ_TO_RGB = np.linalg.inv(_RGB_TO_YIQ).astype(np.float32)
+
+
+def distort_color_batch(images, stddev=0.1):
+    """Distort the color of a batch of images with one affine map per image.
+    Draws the parameters of `distort_color` (ordering 0: brightness,
+    saturation, hue, contrast) per sample, and folds them into a 3x3 color
+    matrix plus offset, so the whole chain costs one batched matmul instead of
+    four ops with RGB<->HSV round trips per example. Saturation and hue are the
+    usual linear approximations: a blend towards luma and a rotation about the
+    grey axis in YIQ space.
+    Args:
+      images: Tensor [N, H, W, 3].
+      stddev: gaussian noise dev
+    Returns:
+      color-distorted images
+    """
+    with tf.name_scope('distort_color_batch', values=[images]):
+        shape = tf.shape(images)
+        batch_size = shape[0]
+        brightness = tf.random_uniform([batch_size], -32. / 255., 32. / 255.)
+        saturation = tf.random_uniform([batch_size], 0.5, 1.5)
+        hue = tf.random_uniform([batch_size], -0.2, 0.2) * 2. * np.pi
+        contrast = tf.random_uniform([batch_size], 0.5, 1.5)
+
+        def batched(matrix):
+            return tf.tile(tf.constant(matrix)[None], [batch_size, 1, 1])
+
+        # x -> s * x + (1 - s) * luma(x)
+        saturation = saturation[:, None, None]
+        saturation_matrix = (
+            saturation * batched(np.eye(3, dtype=np.float32)) +
+            (1. - saturation) * batched(np.outer(np.ones(3, np.float32), _LUMA))
+        )
+        # Rotate the chroma (I, Q) plane.
+        zeros = tf.zeros_like(hue)
+        ones = tf.ones_like(hue)
+        rotation = tf.reshape(tf.stack([
+            ones, zeros, zeros,
+            zeros, tf.cos(hue), -tf.sin(hue),
+            zeros, tf.sin(hue), tf.cos(hue)
+        ], 1), [-1, 3, 3])
+        hue_matrix = tf.matmul(tf.matmul(batched(_YIQ_TO_RGB), rotation), batched(_RGB_TO_YIQ))
+        matrix = tf.matmul(hue_matrix, saturation_matrix)
+
+        # Contrast blends towards the per-channel mean, which the affine chain maps
+        # like any pixel: M(c * x + (1 - c) * mean + brightness).
+        mean = tf.reduce_mean(images, [1, 2])
+        offset = (1. - contrast)[:, None] * mean + brightness[:, None]
+        offset = tf.matmul(matrix, offset[:, :, None])[:, :, 0]
+        matrix = contrast[:, None, None] * matrix
+
+        pixels = tf.reshape(images, [batch_size, -1, 3])
+        pixels = tf.matmul(pixels, matrix, transpose_b=True) + offset[:, None, :]
+        images = tf.reshape(pixels, shape)
+
+        images += tf.random_normal(
+                shape,
+                stddev=stddev,
+                dtype=tf.float32,
+                seed=42,
+                name='add_gaussian_noise')
+        images = tf.clip_by_value(images, 0.0, 1.0)
+        return images
+
+
+def occlude(images, negatives, probability=.3, area=.15, min_height=.15, max_height=1.):
+    """Paste a random rectangle of a random negative image over each image.
+    Args:
+        images: float Tensor [N, H, W, C] in [0, 1].
+        negatives: uint8 Tensor [M, H, W, C].
+        probability: chance of occluding each image.
+        area: occluded area as a fraction of the image.
+        min_height: minimum rectangle height as a fraction of the image height.
+        max_height: maximum rectangle height as a fraction of the image height.
+    Returns:
+        occluded images
+    """
+    with tf.name_scope('occlude', values=[images, negatives]):
+        shape = tf.shape(images)
+        batch_size, height, width = shape[0], shape[1], shape[2]
+        f_height = tf.cast(height, tf.float32)
+        f_width = tf.cast(width, tf.float32)
+
+        rh = tf.random_uniform([batch_size], min_height, max_height) * f_height
+        rh = tf.minimum(tf.floor(rh), f_height)
+        rw = tf.minimum(tf.floor(f_height * f_width * area / rh), f_width)
+        dy = tf.floor(tf.random_uniform([batch_size]) * (f_height - rh))
+        dx = tf.floor(tf.random_uniform([batch_size]) * (f_width - rw))
+        apply = tf.random_uniform([batch_size]) < probability
+
+        ys = tf.cast(tf.range(height), tf.float32)[None, :]
+        xs = tf.cast(tf.range(width), tf.float32)[None, :]
+        mask_y = tf.logical_and(ys >= dy[:, None], ys < (dy + rh)[:, None])
+        mask_x = tf.logical_and(xs >= dx[:, None], xs < (dx + rw)[:, None])
+        mask = tf.logical_and(mask_y[:, :, None], mask_x[:, None, :])
+        mask = tf.logical_and(mask, apply[:, None, None])
+        mask = tf.cast(mask, tf.float32)[..., None]
+
+        idx = tf.random_uniform([batch_size], 0, tf.shape(negatives)[0], dtype=tf.int32)
+        patches = tf.cast(tf.gather(negatives, idx), tf.float32) / 255.
+        return images * (1. - mask) + patches * mask
+
+
+def train_augment(negatives=None, occlusion_probability=0.):
+    """Augmentation of the train pipeline: color distortion, then occlusion with
+    `negatives` when given and `occlusion_probability` > 0. The negatives are
+    kept out of the graph def in a local variable fed at initialization, before
+    the iterator initializer captures it.
+    Returns:
+        (augment function for `train_dataset`, feed dict for the local variables initializer)
+    """
+    feed_dict = {}
+    tf_negatives = None
+    if negatives is not None and occlusion_probability > 0:
+        with tf.device('/cpu:0'):
+            tf_negatives_init = tf.placeholder(tf.uint8, negatives.shape, name='NegativesInit')
+            tf_negatives = tf.Variable(
+                tf_negatives_init,
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name='Negatives'
+            )
+        feed_dict[tf_negatives_init] = negatives
+
+    def augment(images, shapes):
+        images = distort_color_batch(images)
+        if tf_negatives is not None:
+            images = occlude(images, tf_negatives, probability=occlusion_probability)
+        return images, shapes
+    return augment, feed_dict
+
+
+def decode_batch(serialized, prefix, num_patches, with_ids=False, image_size=112):
+    """Parse a batch of serialized examples written by `prepare_images`.
+    Args:
+        serialized: 1-D string tensor of serialized `tf.train.Example`.
+        prefix: feature prefix, one of 'train', 'validate' or 'test'.
+        num_patches: number of landmarks
+        with_ids: also return the record ids, -1 for records written without one.
+        image_size: side length the images were prepared at.
+    Returns:
+        images [N, image_size, image_size, 3], shapes [N, num_patches, 2] and, with_ids, ids [N]
+    """
+    feature = {
+        prefix + '/image': tf.FixedLenFeature([], tf.string),
+        prefix + '/shape': tf.FixedLenFeature([num_patches * 2], tf.float32),
+    }
+    if with_ids:
+        feature[prefix + '/id'] = tf.FixedLenFeature([], tf.int64, default_value=-1)
+    features = tf.parse_example(serialized, features=feature)
+    images = tf.decode_raw(features[prefix + '/image'], tf.float32)
+    images = tf.reshape(images, (-1, image_size, image_size, 3))
+    shapes = tf.reshape(features[prefix + '/shape'], (-1, num_patches, 2))
+    if with_ids:
+        return images, shapes, features[prefix + '/id']
+    return images, shapes
+
+
+def _record_id(serialized, prefix):
+    feature = {prefix + '/id': tf.FixedLenFeature([], tf.int64, default_value=-1)}
+    return tf.parse_single_example(serialized, features=feature)[prefix + '/id']
+
+
+def train_dataset(path_base, batch_size, num_patches, shuffle_buffer=2048, augment=None, keep_probability=None,
+                  threadpool_size=0, image_size=112, deterministic=False):
+    """Repeated, shuffled and batched train set read from `train_*.bin`.
+    Shards are read in parallel and the serialized records are shuffled before
+    decoding, so the shuffle buffer holds compact strings instead of decoded
+    float images. Parsing runs once per batch.
+    Args:
+        path_base: dataset directory holding the shards.
+        batch_size: examples per batch, the last partial batch is dropped.
+        num_patches: number of landmarks
+        shuffle_buffer: number of serialized records to shuffle over.
+        augment: optional function (images, shapes) -> (images, shapes) applied per batch.
+        keep_probability: optional float Tensor indexed by record id; each record
+            is kept with that probability, which oversamples the records with
+            the highest probabilities. Records without id are always kept.
+        threadpool_size: size of a private threadpool for the pipeline, 0 to use
+            the session's inter-op pool.
+        image_size: side length the images were prepared at.
+        deterministic: interleave the shards in a fixed order, so seeded runs
+            see the same batches.
+    Returns:
+        `tf.data.Dataset` of (images, shapes, ids)
+    """
+    shards = sorted(str(p) for p in Path(path_base).glob('train_*.bin'))
+    with tf.name_scope('train_dataset'):
+        dataset = tf.data.Dataset.from_tensor_slices(shards)
+        dataset = dataset.shuffle(len(shards)).repeat()
+        dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=len(shards),
+            sloppy=not deterministic
+        ))
+        dataset = dataset.shuffle(shuffle_buffer)
+        if keep_probability is not None:
+            def keep(serialized):
+                record_id = _record_id(serialized, 'train')
+                return tf.logical_or(
+                    record_id < 0,
+                    tf.random_uniform([]) < tf.gather(keep_probability, tf.maximum(record_id, 0))
+                )
+            dataset = dataset.filter(keep)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+
+        def decode_and_augment(serialized):
+            images, shapes, ids = decode_batch(
+                serialized, 'train', num_patches, with_ids=True, image_size=image_size
+            )
+            if augment is not None:
+                images, shapes = augment(images, shapes)
+            return images, shapes, ids
+        dataset = dataset.map(decode_and_augment, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        if threadpool_size > 0:
+            options = tf.data.Options()
+            options.experimental_threading.private_threadpool_size = threadpool_size
+            dataset = dataset.with_options(options)
+    return dataset
+
+
+def validate_dataset(path_base, batch_size, num_patches, image_size=112):
+    """Repeated and batched validate set, decoded once and cached in memory.
+    Records are cached one by one and repeated before batching, so batches wrap
+    around the end of the set and every record is evaluated.
+    """
+    with tf.name_scope('validate_dataset'):
+        dataset = tf.data.TFRecordDataset([str(Path(path_base) / 'validate.bin')])
+        # Parse in chunks, then cache the decoded records individually.
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(
+            lambda serialized: decode_batch(serialized, 'validate', num_patches, image_size=image_size),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE
+        )
+        dataset = dataset.apply(tf.data.experimental.unbatch())
+        dataset = dataset.cache()
+        dataset = dataset.repeat()
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset
+
+
+def synthetic_batch(batch_size, num_patches, image_size=112):
+    """Random images and shapes held in local variables, so reading them costs no I/O."""
+    with tf.name_scope('SyntheticBatch'):
+        images = tf.Variable(
+            tf.random_uniform([batch_size, image_size, image_size, 3]),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+            name='Images'
+        )
+        shapes = tf.Variable(
+            tf.random_uniform([batch_size, num_patches, 2], 0., float(image_size)),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+            name='Shapes'
+        )
+        mean_shape = tf.random_uniform([num_patches, 2], 0., float(image_size), seed=42)
+    return images.read_value(), shapes.read_value(), mean_shape
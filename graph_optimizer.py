@@ -0,0 +1,224 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import ops
+import time
+
+import mdm_model
+import utils
+
+_BN_VARIABLES = ('gamma', 'beta', 'moving_mean', 'moving_variance')
+_PREDICT_BIAS = 'Predict/Convolution/Conv2D/bias'
+_AVERAGE_SUFFIX = '/ExponentialMovingAverage'
+
+
+def read_variables(sess, var_list=None):
+    """Values of `var_list` (default all global variables) keyed by op name."""
+    if var_list is None:
+        var_list = tf.global_variables()
+    return sess.run({v.op.name: v for v in var_list})
+
+
+def fold_batch_norms(values, mean_shape=None, epsilon=mdm_model.BN_EPSILON):
+    """Fold inference-mode batch norms into the preceding convolutions.
+
+    `BatchNorm` and `BatchNorm2` scale the `Conv2D` kernel of their layer and
+    become its bias; `BatchNorm1` scales the `DWConv2D` depthwise kernel and its
+    offset is pushed through the following 1x1 `Conv2D` into that bias. The mean
+    shape, if given, is added to the Predict bias of the network and of every exit.
+    Args:
+        values: dict of variable name -> value of an MDMModel checkpoint.
+        mean_shape: [num_patches, 2] added to the prediction.
+        epsilon: batch norm epsilon.
+    Returns:
+        dict of variable name -> value for `MDMModel(..., folded=True)`
+    """
+    bn_scopes = sorted({
+        name[:-len('/moving_variance')] for name in values if name.endswith('/moving_variance')
+    })
+    bn_names = {'{}/{}'.format(scope, v) for scope in bn_scopes for v in _BN_VARIABLES}
+    folded = {name: np.array(value) for name, value in values.items() if name not in bn_names}
+
+    depthwise_offsets = {}
+    for scope in bn_scopes:
+        layer, bn = scope.rsplit('/', 1)
+        gamma, beta, mean, variance = (values['{}/{}'.format(scope, v)] for v in _BN_VARIABLES)
+        scale = gamma / np.sqrt(variance + epsilon)
+        offset = beta - mean * scale
+        if bn == 'BatchNorm1':
+            kernel = layer + '/DWConv2D/depthwise_kernel'
+            # [k, k, in, multiplier]; scale is per input channel.
+            folded[kernel] = folded[kernel] * scale[:, None]
+            depthwise_offsets[layer] = offset
+        else:
+            kernel = layer + '/Conv2D/kernel'
+            bias = layer + '/Conv2D/bias'
+            folded[kernel] = folded[kernel] * scale
+            folded[bias] = folded[bias] * scale + offset if bias in folded else offset
+    for layer, offset in depthwise_offsets.items():
+        kernel = folded[layer + '/Conv2D/kernel']
+        folded[layer + '/Conv2D/bias'] = folded[layer + '/Conv2D/bias'] + offset.dot(kernel[0, 0])
+
+    if mean_shape is not None:
+        for name in folded:
+            if name.endswith('/' + _PREDICT_BIAS):
+                folded[name] = folded[name] + np.reshape(mean_shape, [-1])
+    return {name: value.astype(np.float32) for name, value in folded.items()}
+
+
+def singular_values(kernel):
+    """Singular values of a conv kernel [k, k, in, out] seen as a [k * k * in, out] matrix."""
+    return np.linalg.svd(np.reshape(kernel, [-1, kernel.shape[-1]]), compute_uv=False)
+
+
+def energy_rank(kernel, energy):
+    """Smallest rank keeping `energy` of the squared singular values of `kernel`."""
+    squared = np.square(singular_values(kernel))
+    cumulative = np.cumsum(squared) / np.sum(squared)
+    return int(min(np.searchsorted(cumulative, energy) + 1, len(squared)))
+
+
+def factorize_kernel(kernel, rank):
+    """Truncated SVD of a conv kernel [k, k, in, out].
+    Returns:
+        ([k, k, in, rank] kernel, [1, 1, rank, out] kernel) whose composition
+        is the best rank `rank` approximation of `kernel`
+    """
+    u, s, vt = np.linalg.svd(np.reshape(kernel, [-1, kernel.shape[-1]]), full_matrices=False)
+    root = np.sqrt(s[:rank])
+    basis = np.reshape(u[:, :rank] * root, list(kernel.shape[:-1]) + [rank])
+    return basis.astype(np.float32), (root[:, None] * vt[:rank])[None, None].astype(np.float32)
+
+
+def low_rank_variables(values, ranks):
+    """Factor the `Conv2D` kernels of `_conv2d` layers into `LowRank` and `Conv2D` pairs.
+    Moving averages are factored alike; optimizer slots of the factored kernels are dropped.
+    Args:
+        values: dict of variable name -> value of an MDMModel checkpoint.
+        ranks: dict of layer scope, e.g. 'Network/Finalize/Convolution' -> rank, 0 to keep.
+    Returns:
+        dict of variable name -> value for the model built with those ranks
+    """
+    factored = dict(values)
+    for layer, rank in ranks.items():
+        if rank <= 0:
+            continue
+        kernel = layer + '/Conv2D/kernel'
+        for name in [n for n in factored if n.startswith(kernel + '/')]:
+            del factored[name]
+        for suffix in ('', _AVERAGE_SUFFIX):
+            if kernel + suffix in values:
+                basis, projection = factorize_kernel(values[kernel + suffix], rank)
+                factored[layer + '/LowRank/kernel' + suffix] = basis
+                factored[kernel + suffix] = projection
+    return factored
+
+
+def load_variables(sess, values, var_list=None):
+    """Load `values` keyed by op name into `var_list` (default all global variables)."""
+    if var_list is None:
+        var_list = tf.global_variables()
+    for v in var_list:
+        v.load(values[v.op.name], sess)
+
+
+def freeze(sess, output_names, optimize=False):
+    """Frozen GraphDef of the session graph reduced to what `output_names` need.
+    With `optimize`, Identity and other training-only nodes are removed too.
+    """
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), output_names
+    )
+    if optimize:
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+        graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    return graph_def
+
+
+def count_nodes(graph_def):
+    return len(graph_def.node)
+
+
+def scope_flops(graph, scope):
+    """Floating point operations of the ops under name scope `scope`; shapes must be fully defined."""
+    total = 0
+    for op in graph.get_operations():
+        if not op.name.startswith(scope + '/'):
+            continue
+        try:
+            flops = ops.get_stats_for_node_def(graph, op.node_def, 'flops').value
+        except ValueError:
+            continue
+        total += flops or 0
+    return total
+
+
+def exit_flops(graph, exits, scope='Network'):
+    """Cost of taking each early exit of an MDMModel built with batch size 1.
+    Returns:
+        (list of the flops up to and including each exit in block order, as
+         `MDMModel.exits` and its exit indices, and then Predict,
+         flops of the same network without exit heads)
+    """
+    blocks = ['ShuffleBlock{}'.format(i) for i in (1, 2, 3)]
+    flops = {
+        name: scope_flops(graph, '{}/{}'.format(scope, name))
+        for name in ['Initial', 'Finalize', 'Predict'] + blocks + ['{}Exit'.format(e) for e in exits]
+    }
+    costs = []
+    total = flops['Initial']
+    for block in blocks:
+        total += flops[block]
+        if block in exits:
+            total += flops['{}Exit'.format(block)]
+            costs.append(total)
+    costs.append(total + flops['Finalize'] + flops['Predict'])
+    baseline = flops['Initial'] + sum(flops[b] for b in blocks) + flops['Finalize'] + flops['Predict']
+    return costs, baseline
+
+
+def max_output_difference(graph_defs, input_name, output_names, config=None):
+    """Largest absolute difference between the outputs of frozen graphs run on
+    the same random input.
+    """
+    feed = None
+    outputs = []
+    for graph_def in graph_defs:
+        with tf.Graph().as_default() as graph:
+            tf.import_graph_def(graph_def, name='')
+            tf_input = graph.get_tensor_by_name(input_name + ':0')
+            if feed is None:
+                feed = np.random.uniform(size=tf_input.shape.as_list()).astype(np.float32)
+            with tf.Session(graph=graph, config=config or utils.session_config()) as sess:
+                outputs.append(sess.run(
+                    [name + ':0' for name in output_names], feed_dict={tf_input: feed}
+                ))
+    return max(
+        float(np.max(np.abs(np.asarray(a, np.float64) - np.asarray(b, np.float64))))
+        for others in outputs[1:] for a, b in zip(outputs[0], others)
+    )
+
+
+def measure_latency(graph_def, input_name, output_name, num_warmup=20, num_runs=200, config=None):
+    """Single-input latency of a frozen graph.
+    Returns:
+        dict with mean/p50/p90 milliseconds per run
+    """
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        tf_input = graph.get_tensor_by_name(input_name + ':0')
+        tf_output = graph.get_tensor_by_name(output_name + ':0')
+        feed = np.random.uniform(size=tf_input.shape.as_list()).astype(np.float32)
+        with tf.Session(graph=graph, config=config or utils.session_config()) as sess:
+            for _ in range(num_warmup):
+                sess.run(tf_output, feed_dict={tf_input: feed})
+            durations = []
+            for _ in range(num_runs):
+                start_time = time.time()
+                sess.run(tf_output, feed_dict={tf_input: feed})
+                durations.append(time.time() - start_time)
+    durations = np.array(durations) * 1000.
+    return {
+        'mean_ms': float(np.mean(durations)),
+        'p50_ms': float(np.percentile(durations, 50)),
+        'p90_ms': float(np.percentile(durations, 90)),
+    }
@@ -0,0 +1,85 @@
+import json
+import numpy as np
+from pathlib import Path
+import tensorflow as tf
+from tensorflow.python.ops import resource_variable_ops
+
+
+def num_train_records(path_base):
+    """Number of train records written by `data_provider.prepare_images`."""
+    meta_path = Path(path_base) / 'train_meta.json'
+    if not meta_path.exists():
+        raise IOError('{} not found, rerun prepare_images to write record ids'.format(meta_path))
+    with meta_path.open('r') as ifs:
+        return json.load(ifs)['num_records']
+
+
+class HardExampleMiner:
+    """Online hard-example mining over the train records.
+
+    Keeps a running NME per record id from the `batch_nme` of every train step
+    and periodically turns it into the per-record keep probabilities that
+    `data_provider.train_dataset` samples with. Records are weighted by
+    (nme / mean nme) ** power; records not seen yet get the largest weight.
+
+    The keep probabilities are a resource variable: the pipeline reads it on
+    every record, whereas a ref variable would be captured by value when the
+    iterator is initialized and `refresh` would never reach it.
+    """
+
+    def __init__(self, num_records, decay=0.9, power=1.0, min_probability=0.2, name='HardExampleMiner'):
+        self.decay = decay
+        self.power = power
+        self.min_probability = min_probability
+        self.nme = np.full(num_records, np.nan, dtype=np.float32)
+        self.probability = np.ones(num_records, dtype=np.float32)
+        self._sampled = []
+
+        with tf.name_scope(name), tf.device('/cpu:0'):
+            self.tf_keep_probability = resource_variable_ops.ResourceVariable(
+                tf.ones([num_records], dtype=tf.float32),
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name='KeepProbability'
+            )
+            self._tf_new_probability = tf.placeholder(tf.float32, [num_records], name='NewKeepProbability')
+            self._assign_op = self.tf_keep_probability.assign(self._tf_new_probability)
+
+    def update(self, ids, batch_nme):
+        """Fold the per-sample NME of one train batch into the running NME."""
+        valid = ids >= 0
+        ids = ids[valid]
+        batch_nme = batch_nme[valid]
+        self._sampled.extend(self.probability[ids])
+        old = self.nme[ids]
+        self.nme[ids] = np.where(
+            np.isnan(old),
+            batch_nme,
+            self.decay * old + (1. - self.decay) * batch_nme
+        )
+
+    def keep_probability(self):
+        seen = ~np.isnan(self.nme)
+        probability = np.ones_like(self.nme)
+        if not seen.any():
+            return probability
+        weight = (self.nme[seen] / np.mean(self.nme[seen])) ** self.power
+        max_weight = max(np.max(weight), 1.)
+        probability[seen] = np.maximum(weight / max_weight, self.min_probability)
+        return probability
+
+    def sampled_probability(self):
+        """Mean keep probability of the records trained on since the last refresh.
+        Above the mean over all records when the pipeline follows the probabilities.
+        """
+        if not self._sampled:
+            return None
+        return float(np.mean(self._sampled))
+
+    def refresh(self, sess):
+        """Push the current keep probabilities to the input pipeline."""
+        probability = self.keep_probability()
+        sess.run(self._assign_op, feed_dict={self._tf_new_probability: probability})
+        self.probability = probability
+        self._sampled = []
+        return probability
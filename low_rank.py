@@ -0,0 +1,203 @@
+"""Low-rank compression of the Finalize and Predict convs: each is replaced by a
+truncated-SVD pair, the ranks are chosen by an energy or accuracy target, the
+compressed model is fine-tuned briefly and exported, and the size, latency and
+validation NME are reported against the uncompressed model.
+
+    python low_rank.py -c=config.json --energy=0.95
+    python low_rank.py -c=config.json --nme_tolerance=0.002 --finetune_steps=2000
+
+Without --energy, the lowest energy in --energies whose ranks keep the NME of
+the factored model, before fine-tuning, within --nme_tolerance of the baseline
+is used. Set finalize_rank and predict_rank in the config to the reported ranks
+to train, evaluate or export the compressed model with the other tools.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from datetime import datetime
+import json
+import numpy as np
+from pathlib import Path
+import tensorflow as tf
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_float('energy', 0., """Squared singular value energy to keep, 0 to search --energies.""")
+tf.flags.DEFINE_string('energies', '0.8,0.85,0.9,0.95,0.98,0.99', """Energies searched, comma separated.""")
+tf.flags.DEFINE_float('nme_tolerance', 0.002, """Validation NME increase allowed by the search.""")
+tf.flags.DEFINE_integer('finetune_steps', 2000, """Fine-tune steps of the compressed model, 0 to skip.""")
+tf.flags.DEFINE_integer('nme_batches', 20, """Validate batches averaged for the NME.""")
+tf.flags.DEFINE_string('compress_dir', 'ckpt/low_rank', """Output directory.""")
+
+import ckpt2pb
+import graph_optimizer
+import mdm_train
+import utils
+
+_LAYERS = (
+    ('finalize_rank', 'Network/Finalize/Convolution'),
+    ('predict_rank', 'Network/Predict/Convolution'),
+)
+
+
+def write_checkpoint(values, checkpoint_path):
+    """Save `values` keyed by variable name as a checkpoint `mdm_train` can start from."""
+    if not Path(checkpoint_path).parent.exists():
+        Path(checkpoint_path).parent.mkdir(parents=True)
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+        var_list = {
+            name: tf.Variable(value, name='Variable{}'.format(i))
+            for i, (name, value) in enumerate(sorted(values.items()))
+        }
+        sess.run(tf.variables_initializer(list(var_list.values())))
+        tf.train.Saver(var_list).save(sess, checkpoint_path)
+    return checkpoint_path
+
+
+def layer_ranks(model_config):
+    """Rank config keys to layer scopes, as `graph_optimizer.low_rank_variables` takes them."""
+    return {layer: model_config[key] for key, layer in _LAYERS}
+
+
+def energy_ranks(values, energy):
+    """Ranks keeping `energy`; 0 where the pair would not be smaller than the conv."""
+    ranks = {}
+    for key, layer in _LAYERS:
+        kernel = values[layer + '/Conv2D/kernel']
+        rank = graph_optimizer.energy_rank(kernel, energy)
+        inputs, outputs = np.prod(kernel.shape[:-1]), kernel.shape[-1]
+        ranks[key] = rank if rank * (inputs + outputs) < inputs * outputs else 0
+    return ranks
+
+
+def head_parameters(values):
+    """Weights of the Finalize and Predict convs."""
+    return int(sum(
+        np.size(value) for name, value in values.items()
+        if any(name.startswith(layer + '/') for _, layer in _LAYERS)
+        and name.rsplit('/', 1)[-1] in ('kernel', 'bias')
+    ))
+
+
+def choose_ranks(values, base_config, mean_shape, baseline_nme):
+    """Ranks for --energy, or the smallest of the --energies search within --nme_tolerance.
+    Returns:
+        (dict of rank config keys, list of the search results)
+    """
+    if FLAGS.energy > 0:
+        return energy_ranks(values, FLAGS.energy), []
+    search = []
+    for energy in sorted(float(e) for e in FLAGS.energies.split(',')):
+        ranks = energy_ranks(values, energy)
+        model_config = dict(base_config, **ranks)
+        nme = mdm_train.validation_nme(
+            graph_optimizer.low_rank_variables(values, layer_ranks(model_config)),
+            model_config, mean_shape, FLAGS.nme_batches, config=utils.cpu_config()
+        )
+        search.append(dict(ranks, energy=energy, nme=nme))
+        print('%s: energy %.3f, ranks %s: nme %.4f' % (datetime.now(), energy, ranks, nme))
+        if nme - baseline_nme <= FLAGS.nme_tolerance:
+            return ranks, search
+    return {key: 0 for key, _ in _LAYERS}, search
+
+
+def export(checkpoint_path, mean_shape, model_config, pb_path):
+    """Freeze and write the optimized graph.
+    Returns:
+        dict with the graph size and its CPU latency
+    """
+    _, graph_def = ckpt2pb.freeze_checkpoint(checkpoint_path, mean_shape, model_config, config=utils.cpu_config())
+    with tf.gfile.FastGFile(pb_path, mode='wb') as f:
+        f.write(graph_def.SerializeToString())
+    latency = graph_optimizer.measure_latency(
+        graph_def, 'Inputs/InputImage', ckpt2pb.output_name(model_config), config=utils.cpu_config()
+    )
+    return {'pb_bytes': graph_def.ByteSize(), 'latency_ms': latency['p50_ms']}
+
+
+def main(_):
+    base_config = dict(mdm_train.g_config)
+    if base_config['finalize_rank'] or base_config['predict_rank']:
+        raise ValueError('Compress an uncompressed model; set finalize_rank and predict_rank to 0')
+    ckpt = tf.train.get_checkpoint_state(base_config['train_dir'])
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise IOError('No checkpoint found in {}'.format(base_config['train_dir']))
+    compress_dir = Path(FLAGS.compress_dir)
+    if not compress_dir.exists():
+        compress_dir.mkdir(parents=True)
+
+    mean_shape = ckpt2pb.load_mean_shape()
+    values = mdm_train.read_checkpoint(ckpt.model_checkpoint_path)
+    baseline_nme = mdm_train.validation_nme(values, base_config, mean_shape, FLAGS.nme_batches, utils.cpu_config())
+    print('%s: baseline nme %.4f' % (datetime.now(), baseline_nme))
+    ranks, search = choose_ranks(values, base_config, mean_shape, baseline_nme)
+    if not any(ranks.values()):
+        print('No ranks reach nme_tolerance {}'.format(FLAGS.nme_tolerance))
+        return
+    compressed_config = dict(base_config, **ranks)
+    compressed_values = graph_optimizer.low_rank_variables(values, layer_ranks(compressed_config))
+    factored_nme = mdm_train.validation_nme(
+        compressed_values, compressed_config, mean_shape, FLAGS.nme_batches, utils.cpu_config()
+    )
+    compressed_path = write_checkpoint(compressed_values, str(compress_dir / 'init' / 'model.ckpt'))
+
+    if FLAGS.finetune_steps > 0:
+        train_dir = compress_dir / 'finetune'
+        print('%s: fine-tuning ranks %s for %d steps...' % (datetime.now(), ranks, FLAGS.finetune_steps))
+        mdm_train.g_config.update(compressed_config)
+        mdm_train.g_config.update(
+            max_steps=FLAGS.finetune_steps,
+            train_dir=str(train_dir),
+            ckpt_dir=str(compress_dir / 'init'),
+            partial_restore=True
+        )
+        try:
+            mdm_train.train()
+        finally:
+            mdm_train.g_config.update(base_config)
+        compressed_path = tf.train.get_checkpoint_state(str(train_dir)).model_checkpoint_path
+        compressed_values = mdm_train.read_checkpoint(compressed_path)
+
+    results = []
+    for name, model_config, checkpoint_path, model_values in (
+            ('baseline', base_config, ckpt.model_checkpoint_path, values),
+            ('low_rank', compressed_config, compressed_path, compressed_values)
+    ):
+        result = export(checkpoint_path, mean_shape, model_config, str(compress_dir / (name + '.pb')))
+        result.update({
+            'name': name,
+            'finalize_rank': model_config['finalize_rank'],
+            'predict_rank': model_config['predict_rank'],
+            'head_parameters': head_parameters(model_values),
+            'nme': mdm_train.validation_nme(
+                model_values, model_config, mean_shape, FLAGS.nme_batches, utils.cpu_config()
+            ),
+        })
+        results.append(result)
+
+    print('{:<10} {:>8} {:>8} {:>12} {:>10} {:>12} {:>8}'.format(
+        'model', 'finalize', 'predict', 'head_params', 'pb_kb', 'latency_ms', 'nme'
+    ))
+    for result in results:
+        print('{:<10} {:>8} {:>8} {:>12} {:>10.1f} {:>12.3f} {:>8.4f}'.format(
+            result['name'], result['finalize_rank'], result['predict_rank'], result['head_parameters'],
+            result['pb_bytes'] / 1024., result['latency_ms'], result['nme']
+        ))
+    baseline, compressed = results
+    deltas = {
+        key: compressed[key] - baseline[key]
+        for key in ('head_parameters', 'pb_bytes', 'latency_ms', 'nme')
+    }
+    print('delta: {}'.format(json.dumps(deltas, sort_keys=True)))
+    with open(str(compress_dir / 'low_rank.json'), 'w') as ofs:
+        json.dump({
+            'results': results,
+            'deltas': deltas,
+            'factored_nme': factored_nme,
+            'search': search,
+            'finetune_steps': FLAGS.finetune_steps,
+        }, ofs, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    tf.app.run()
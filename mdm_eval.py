@@ -14,7 +14,9 @@ import tensorflow as tf
 import time
 
 import data_provider
+import graph_optimizer
 import mdm_model
+import thread_tuner
 import utils
 
 g_config = utils.load_config()
@@ -48,10 +50,13 @@ def flip_predictions(predictions, shapes):
 
 
 def evaluate():
+    utils.set_cpu_affinity(g_config['cpu_affinity'])
+    threads = thread_tuner.thread_settings(g_config)
     with tf.Graph().as_default(), tf.device('/cpu:0'):
         path_base = Path(g_config['eval_dataset']).parent.parent
         _mean_shape = mio.import_pickle(path_base / 'mean_shape.pkl')
-        _mean_shape = data_provider.align_reference_shape_to_112(_mean_shape)
+        _mean_shape = data_provider.align_reference_shape_to_size(_mean_shape, g_config['image_size'])
+        image_size = g_config['image_size']
         tf_mean_shape = tf.constant(_mean_shape, dtype=tf.float32, name='MeanShape')
 
         def decode_feature(serialized):
@@ -62,20 +67,20 @@ def evaluate():
             }
             features = tf.parse_single_example(serialized, features=feature)
             decoded_image = tf.decode_raw(features['test/image'], tf.float32)
-            decoded_image = tf.reshape(decoded_image, (112, 112, 3))
+            decoded_image = tf.reshape(decoded_image, (image_size, image_size, 3))
             decoded_shape = tf.sparse.to_dense(features['test/shape'])
             decoded_shape = tf.reshape(decoded_shape, (g_config['num_patches'], 2))
             return decoded_image, decoded_shape
 
         with tf.name_scope('DataProvider', values=[]):
-            tf_dataset = tf.data.TFRecordDataset([str(path_base / 'test.bin')])
+            tf_dataset = tf.data.TFRecordDataset([str(data_provider.record_dir(path_base, image_size) / 'test.bin')])
             tf_dataset = tf_dataset.map(decode_feature)
             tf_dataset = tf_dataset.batch(1)
             tf_dataset = tf_dataset.prefetch(1000)
             tf_iterator = tf_dataset.make_one_shot_iterator()
             tf_images, tf_shapes = tf_iterator.get_next(name='batch')
-            tf_images.set_shape((1, 112, 112, 3))
-            tf_shapes.set_shape((1, 75, 2))
+            tf_images.set_shape((1, image_size, image_size, 3))
+            tf_shapes.set_shape((1, g_config['num_patches'], 2))
 
         print('Loading model...')
         with tf.device(g_config['eval_device']):
@@ -84,11 +89,20 @@ def evaluate():
                 tf_shapes,
                 tf_mean_shape,
                 batch_size=1,
-                num_patches=g_config['num_patches'],
-                num_channels=3,
-                multiplier=g_config['multiplier'],
-                is_training=False
+                is_training=False,
+                use_xla=g_config['use_xla'],
+                dtype=g_config['precision'],
+                inference_only=True,
+                **mdm_model.config_kwargs(g_config)
             )
+            model.attach_loss()
+            tf_exit_index = tf.constant(0)
+            tf_exit_nme = tf.constant([0.])
+            if g_config['exits']:
+                # Also evaluate what an exported per-request early-exit graph returns,
+                # next to the full network.
+                _, tf_exit_index = model.attach_early_exit(g_config['exit_threshold'])
+                tf_exit_nme = model.early_exit_batch_nme
 
         # Restore the moving average version of the learned variables for eval.
         variable_averages = tf.train.ExponentialMovingAverage(g_config['MOVING_AVERAGE_DECAY'])
@@ -98,8 +112,7 @@ def evaluate():
         graph_def = tf.get_default_graph().as_graph_def()
         summary_writer = tf.summary.FileWriter(g_config['eval_dir'], graph_def=graph_def)
 
-        config = tf.ConfigProto(allow_soft_placement=True)
-        config.gpu_options.allow_growth = True
+        config = utils.session_config(threads['intra_op_threads'], threads['inter_op_threads'])
         with tf.Session(config=config) as sess:
             ckpt = tf.train.get_checkpoint_state(g_config['train_dir'])
             if ckpt and ckpt.model_checkpoint_path:
@@ -123,15 +136,23 @@ def evaluate():
             # Counts the number of correct predictions.
             errors = []
             mean_errors = []
+            exit_indices = []
+            exit_errors = []
 
             print('%s: starting evaluation on (%s).' % (datetime.now(), g_config['eval_dataset']))
             start_time = time.time()
             for step in range(num_iter):
-                nme, ne, img = sess.run([model.batch_nme, model.batch_ne, model.out_images])
+                nme, ne, img, shape, pred, exit_index, exit_nme = sess.run([
+                    model.batch_nme, model.batch_ne, tf_images, tf_shapes, model.prediction, tf_exit_index,
+                    tf_exit_nme
+                ])
                 error_level = min(9, int(nme[0] * 100))
-                plt.imsave('Evaluate/err{}/step{}.png'.format(error_level, step), img[0])
+                img = utils.draw_landmarks(img[0], shape[0], pred[0])
+                plt.imsave('Evaluate/err{}/step{}.png'.format(error_level, step), img)
                 errors.append(ne)
                 mean_errors.append(nme)
+                exit_indices.append(exit_index)
+                exit_errors.append(exit_nme)
                 step += 1
                 if step % 20 == 0:
                     duration = time.time() - start_time
@@ -164,6 +185,22 @@ def evaluate():
                 '%s: mean_rmse = %.4f, auc @ 0.05 = %.4f, auc @ 0.08 = %.4f [%d examples]' %
                 (datetime.now(), mean_errors.mean(), auc_at_05, auc_at_08, num_iter)
             )
+            if g_config['exits']:
+                costs, baseline = graph_optimizer.exit_flops(tf.get_default_graph(), model.exits)
+                exit_indices = np.array(exit_indices)
+                for index, name in enumerate(model.exits + ['Predict']):
+                    print('%s: exit %s taken by %.4f of examples' % (
+                        datetime.now(), name, np.mean(exit_indices == index)
+                    ))
+                exit_errors = np.vstack(exit_errors).ravel()
+                print('%s: exit threshold %.2f, average compute saved = %.4f' % (
+                    datetime.now(), g_config['exit_threshold'],
+                    1. - np.mean(np.array(costs)[exit_indices]) / baseline
+                ))
+                print('%s: early exit mean_rmse = %.4f (full network %.4f), auc @ 0.05 = %.4f, auc @ 0.08 = %.4f' % (
+                    datetime.now(), exit_errors.mean(), mean_errors.mean(),
+                    (exit_errors < .05).mean(), (exit_errors < .08).mean()
+                ))
 
             ced_image = plot_ced([mean_errors.tolist()], ['MDM'])
             ced_plot = sess.run(tf.summary.merge([tf.summary.image('ced_plot', ced_image[None, ...])]))
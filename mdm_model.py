@@ -81,6 +81,45 @@ def _depthwise_conv2d(inputs,
     return layer.apply(inputs)
 
 
+def _float32_variable_getter(getter, name, shape=None, dtype=None, trainable=True, *args, **kwargs):
+    """Store trainable variables in float32 and cast them to the requested dtype on read."""
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, dtype=storage_dtype, trainable=trainable, *args, **kwargs)
+    if trainable and dtype is not None and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
+def _frozen_variable_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    """Float32 local, non-trainable variables cast to the requested dtype on read, for a
+    model that is neither optimized, averaged nor saved with the one being trained."""
+    kwargs.update(trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    variable = getter(name, shape, dtype=tf.float32, *args, **kwargs)
+    if dtype is not None and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
+BN_EPSILON = 1e-3
+
+
+def _channel_axis(data_format):
+    return 1 if data_format == 'channels_first' else -1
+
+
+def _batch_normalization(inputs, training, name, data_format='channels_last'):
+    """Batch norm computed in float32, so its parameters and statistics stay float32."""
+    dtype = inputs.dtype
+    inputs = tf.layers.batch_normalization(
+        tf.cast(inputs, tf.float32),
+        axis=_channel_axis(data_format),
+        epsilon=BN_EPSILON,
+        training=training,
+        name=name
+    )
+    return tf.cast(inputs, dtype)
+
+
 def _conv2d(
         inputs,
         filters,
@@ -90,21 +129,32 @@ def _conv2d(
         use_bias=True,
         use_bn=False,
         training=False,
+        fold_bn=False,
+        data_format='channels_last',
+        rank=0,
         name='Convolution'
 ):
+    """With `rank` > 0 the conv is factored into a bias-free `LowRank` conv to
+    `rank` channels and a 1x1 `Conv2D` to `filters`."""
     with tf.variable_scope(name, values=[inputs]):
+        if rank > 0:
+            inputs = tf.layers.conv2d(
+                inputs, rank, kernel_size, strides,
+                padding='same',
+                data_format=data_format,
+                use_bias=False,
+                name='LowRank'
+            )
+            kernel_size, strides = [1, 1], [1, 1]
         inputs = tf.layers.conv2d(
             inputs, filters, kernel_size, strides,
             padding='same',
-            use_bias=use_bias,
+            data_format=data_format,
+            use_bias=use_bias or (use_bn and fold_bn),
             name='Conv2D'
         )
-        if use_bn:
-            inputs = tf.layers.batch_normalization(
-                inputs,
-                training=training,
-                name='BatchNorm'
-            )
+        if use_bn and not fold_bn:
+            inputs = _batch_normalization(inputs, training, 'BatchNorm', data_format)
         if activation is not None:
             inputs = activation(inputs)
     return inputs
@@ -119,38 +169,59 @@ def _conv2d_dw(
         use_bias=True,
         use_bn=False,
         training=False,
+        fold_bn=False,
+        data_format='channels_last',
         name='DepthWiseConvolution'
 ):
+    # With fold_bn the depthwise offset is carried by the 1x1 conv bias.
     with tf.variable_scope(name, values=[inputs]):
         inputs = _depthwise_conv2d(
             inputs, kernel_size, strides,
             padding='same',
+            data_format=data_format,
             use_bias=use_bias,
             name='DWConv2D'
         )
-        if use_bn:
-            inputs = tf.layers.batch_normalization(
-                inputs,
-                training=training,
-                name='BatchNorm1'
-            )
+        if use_bn and not fold_bn:
+            inputs = _batch_normalization(inputs, training, 'BatchNorm1', data_format)
         inputs = tf.layers.conv2d(
             inputs, filters, [1, 1],
             padding='same',
-            use_bias=use_bias,
+            data_format=data_format,
+            use_bias=use_bias or (use_bn and fold_bn),
             name='Conv2D'
         )
-        if use_bn:
-            inputs = tf.layers.batch_normalization(
-                inputs,
-                training=training,
-                name='BatchNorm2'
-            )
+        if use_bn and not fold_bn:
+            inputs = _batch_normalization(inputs, training, 'BatchNorm2', data_format)
         if activation is not None:
             inputs = activation(inputs)
     return inputs
 
 
+def _channel_halves(pieces, axis=-1):
+    """Split the channels of concat(pieces) into two halves, given as lists of pieces.
+    Only a piece that straddles the middle is sliced."""
+    sizes = [piece.shape[axis].value for piece in pieces]
+    middle = sum(sizes) // 2
+    first, second = [], []
+    offset = 0
+    for piece, size in zip(pieces, sizes):
+        if offset + size <= middle:
+            first.append(piece)
+        elif offset >= middle:
+            second.append(piece)
+        else:
+            head, tail = tf.split(piece, [middle - offset, offset + size - middle], axis)
+            first.append(head)
+            second.append(tail)
+        offset += size
+    return first, second
+
+
+def _concat(pieces, axis=-1):
+    return pieces[0] if len(pieces) == 1 else tf.concat(pieces, axis)
+
+
 def _shuffle_block(
         inputs,
         in_filters,
@@ -159,8 +230,20 @@ def _shuffle_block(
         strides,
         depth,
         training=False,
+        fold_bn=False,
+        channel_shuffle='lazy',
+        data_format='channels_last',
         name='ShuffleBlock'
 ):
+    """ShuffleNet v2 block.
+
+    The bypass branch `left` is kept as a list of pieces whose concat is the
+    branch. channel_shuffle 'split' splits and re-concatenates both branches in
+    every unit. 'lazy' only concatenates the convolution input; the bypass
+    pieces are, after the first unit, exactly its halves, so they are never
+    copied until the block output. Both give identical outputs.
+    """
+    axis = _channel_axis(data_format)
     with tf.variable_scope(name, values=[inputs]):
         with tf.variable_scope('Unit0'):
             left = _conv2d_dw(
@@ -169,14 +252,19 @@ def _shuffle_block(
                 use_bias=False,
                 use_bn=True,
                 training=training,
+                fold_bn=fold_bn,
+                data_format=data_format,
                 name='Bypass'
             )
+            left = [left]
             right = _conv2d(
                 inputs, in_filters, [1, 1],
                 activation=tf.nn.relu,
                 use_bias=False,
                 use_bn=True,
                 training=training,
+                fold_bn=fold_bn,
+                data_format=data_format,
                 name='Convolution1x1'
             )
             right = _conv2d_dw(
@@ -184,21 +272,32 @@ def _shuffle_block(
                 activation=tf.nn.relu,
                 use_bias=False,
                 use_bn=True,
-                training=training, name='DepthWiseConvolution3x3'
+                training=training,
+                fold_bn=fold_bn,
+                data_format=data_format,
+                name='DepthWiseConvolution3x3'
             )
         for i in range(1, depth):
             with tf.variable_scope('Unit{}'.format(i)):
                 with tf.name_scope('ChannelShuffle'):
-                    ll, lr = tf.split(left, 2, -1)
-                    rl, rr = tf.split(right, 2, -1)
-                    left = tf.concat([ll, rl], -1)
-                    right = tf.concat([lr, rr], -1)
+                    if channel_shuffle == 'split':
+                        ll, lr = tf.split(_concat(left, axis), 2, axis)
+                        rl, rr = tf.split(right, 2, axis)
+                        left = [tf.concat([ll, rl], axis)]
+                        right = tf.concat([lr, rr], axis)
+                    else:
+                        ll, lr = _channel_halves(left, axis)
+                        rl, rr = _channel_halves([right], axis)
+                        left = ll + rl
+                        right = _concat(lr + rr, axis)
                 right = _conv2d(
                     right, out_filters // 2, [1, 1],
                     activation=tf.nn.relu,
                     use_bias=False,
                     use_bn=True,
                     training=training,
+                    fold_bn=fold_bn,
+                    data_format=data_format,
                     name='Convolution1x1'
                 )
                 right = _conv2d_dw(
@@ -207,9 +306,44 @@ def _shuffle_block(
                     use_bias=False,
                     use_bn=True,
                     training=training,
+                    fold_bn=fold_bn,
+                    data_format=data_format,
                     name='DepthWiseConvolution3x3'
                 )
-        return tf.concat([left, right], -1)
+        return tf.concat(left + [right], axis)
+
+
+def _bilinear_sample(features, points):
+    """Bilinearly interpolated features at points.
+    Args:
+        features: [N, H, W, C]
+        points: [N, M, 2] (row, col) in feature cells, clamped to the map.
+    Returns:
+        [N, M, C]
+    """
+    height, width = features.shape[1].value, features.shape[2].value
+    points = tf.minimum(tf.maximum(points, 0.), [height - 1., width - 1.])
+    top_left = tf.floor(points)
+    fraction = points - top_left
+    top_left = tf.cast(top_left, tf.int32)
+    bottom_right = tf.minimum(top_left + 1, [height - 1, width - 1])
+    batch_index = tf.tile(tf.range(tf.shape(points)[0])[:, None], [1, tf.shape(points)[1]])
+
+    def gather(rows, cols):
+        return tf.gather_nd(features, tf.stack([batch_index, rows, cols], -1))
+
+    row_fraction, col_fraction = fraction[..., 0:1], fraction[..., 1:2]
+    top = (gather(top_left[..., 0], top_left[..., 1]) * (1. - col_fraction)
+           + gather(top_left[..., 0], bottom_right[..., 1]) * col_fraction)
+    bottom = (gather(bottom_right[..., 0], top_left[..., 1]) * (1. - col_fraction)
+              + gather(bottom_right[..., 0], bottom_right[..., 1]) * col_fraction)
+    return top * (1. - row_fraction) + bottom * row_fraction
+
+
+def _global_average_pooling(inputs, data_format, name):
+    """Average over all spatial positions, so the head follows the input size."""
+    spatial_axes = [2, 3] if data_format == 'channels_first' else [1, 2]
+    return tf.reduce_mean(inputs, spatial_axes, keepdims=True, name=name)
 
 
 def _batch_normalized_error(pred, gt_truth, num_patches=73):
@@ -229,14 +363,86 @@ def _normalized_mean_error(pred, gt_truth, num_patches=73):
 
 _INIT_DEPTH = 48
 _DEPTH_BASE = 96
+_EXIT_DEPTH = 128
+_REFINE_ENCODE_DEPTH = 64
+_REFINE_HIDDEN_DEPTH = 256
+
+
+def config_kwargs(g_config):
+    """MDMModel architecture arguments read from a config, so every tool builds
+    the network the checkpoint was trained with. Runtime arguments (is_training,
+    use_xla, dtype, ...) are left to the caller.
+    """
+    return {
+        'num_patches': g_config['num_patches'],
+        'num_channels': 3,
+        'multiplier': g_config['multiplier'],
+        'data_format': g_config['data_format'],
+        'block_depths': g_config['block_depths'],
+        'exits': g_config['exits'],
+        'refine_iterations': g_config['refine_iterations'],
+        'refine_features': g_config['refine_features'],
+        'refine_patch': g_config['refine_patch'],
+        'finalize_rank': g_config['finalize_rank'],
+        'predict_rank': g_config['predict_rank'],
+    }
 
 
 class MDMModel:
+    """ShuffleNet landmark regressor.
+
+    With `inference_only` only the network and `prediction` are built, `shapes`
+    may be None, and the loss and the landmark drawing can be added later with
+    `attach_loss` and `attach_visualization`.
+
+    With `folded` the network is built for weights from
+    `graph_optimizer.fold_batch_norms`: no batch norm layers, conv biases in
+    their place and the mean shape in the Predict bias, so `mean_shape` is unused.
+
+    `block_depths` are the numbers of units of ShuffleBlock1-3.
+
+    `data_format` 'channels_first' runs the network in NCHW; `images` stay NHWC
+    and are transposed once. Variables are the same in both formats.
+
+    With `trainable` False the variables are frozen local variables under
+    `name`, e.g. for a distillation teacher restored from a `Network` checkpoint.
+
+    `exits` names the blocks ('ShuffleBlock1', 'ShuffleBlock2') followed by an
+    early-exit head with its own landmarks and confidence; see `attach_exit_loss`
+    and `attach_early_exit`. They are kept in block order, which exit indices
+    refer to. Exits cannot be combined with refinement, which the early-exit
+    path does not run.
+
+    `finalize_rank` and `predict_rank` > 0 build the Finalize and Predict convs
+    as low-rank pairs, e.g. for weights from `graph_optimizer.low_rank_variables`.
+
+    With `refine_iterations` > 0 the prediction is refined that many times by
+    regressing a residual from `refine_features` bilinearly sampled on a
+    `refine_patch` x `refine_patch` grid around every landmark. The iterations
+    share their weights, so fewer can be run at inference than in training.
+    """
+
     def __init__(
             self, images, shapes, mean_shape,
             batch_size, num_patches, num_channels,
             multiplier=1.0,
-            is_training=True
+            is_training=True,
+            use_xla=False,
+            dtype=tf.float32,
+            recompute=False,
+            inference_only=False,
+            folded=False,
+            channel_shuffle='lazy',
+            data_format='channels_last',
+            block_depths=(4, 8, 4),
+            trainable=True,
+            exits=(),
+            refine_iterations=0,
+            refine_features='ShuffleBlock1',
+            refine_patch=3,
+            finalize_rank=0,
+            predict_rank=0,
+            name='Network'
     ):
         self.in_images = images
         self.in_shapes = shapes
@@ -246,65 +452,85 @@ class MDMModel:
         self.num_channels = num_channels
         self.multiplier = multiplier
         self.is_training = is_training
+        self.use_xla = use_xla
+        self.dtype = tf.as_dtype(dtype)
+        self.recompute = recompute
+        self.folded = folded
+        self.channel_shuffle = channel_shuffle
+        self.data_format = data_format
+        self.block_depths = tuple(block_depths)
+        self.trainable = trainable
+        blocks = ['ShuffleBlock{}'.format(index + 1) for index in range(len(self.block_depths))]
+        unknown = sorted(set(exits) - set(blocks))
+        if unknown:
+            raise ValueError('Unknown exits {}, expected some of {}'.format(unknown, blocks))
+        self.exits = [block for block in blocks if block in exits]
+        if self.exits and refine_iterations > 0:
+            raise ValueError('exits cannot be combined with refine_iterations > 0')
+        self.refine_iterations = refine_iterations
+        self.refine_features = refine_features
+        self.refine_patch = refine_patch
+        self.finalize_rank = finalize_rank
+        self.predict_rank = predict_rank
         self.depth = (int(_DEPTH_BASE * self.multiplier) + 3) // 4 * 4
 
-        with tf.variable_scope('Network', values=[self.in_mean_shape], reuse=tf.AUTO_REUSE):
-            with tf.variable_scope('Initial'):
-                inputs = _conv2d(
-                    self.in_images, _INIT_DEPTH, [3, 3],
-                    activation=tf.nn.relu,
-                    use_bias=False,
-                    use_bn=True,
-                    training=self.is_training,
-                    name='Convolution'
-                )
-                inputs = tf.layers.max_pooling2d(
-                    inputs, [2, 2], [2, 2],
-                    name='MaxPooling'
-                )
-            inputs = _shuffle_block(
-                inputs, _INIT_DEPTH, self.depth, [3, 3], [2, 2], 4,
-                training=self.is_training,
-                name='ShuffleBlock1'
-            )
-            inputs = _shuffle_block(
-                inputs, self.depth, 2 * self.depth, [3, 3], [2, 2], 8,
-                training=self.is_training,
-                name='ShuffleBlock2'
-            )
-            inputs = _shuffle_block(
-                inputs, 2 * self.depth, 4 * self.depth, [3, 3], [2, 2], 4,
-                training=self.is_training,
-                name='ShuffleBlock3'
-            )
-            with tf.variable_scope('Finalize'):
-                inputs = _conv2d(
-                    inputs, 1024, [1, 1],
-                    activation=tf.nn.relu,
-                    name='Convolution'
-                )
-                inputs = tf.layers.dropout(
-                    inputs, 0.2,
-                    training=self.is_training,
-                    name='Dropout'
-                )
-                inputs = tf.layers.average_pooling2d(
-                    inputs, [7, 7], [1, 1],
-                    name='AvgPooling'
-                )
-            with tf.variable_scope('Predict'):
-                inputs = _conv2d(
-                    inputs, 150, [1, 1],
-                    name='Convolution'
-                )
-                inputs = tf.reshape(inputs, [-1, 75, 2])
-                self.prediction = inputs + self.in_mean_shape
-            with tf.name_scope('BatchLoss'):
-                self.batch_ne = _batch_normalized_error(self.prediction, self.in_shapes)
-                self.batch_nme = tf.reduce_mean(self.batch_ne, 1)
-            with tf.name_scope('Loss'):
-                self.nme = tf.reduce_mean(self.batch_nme)
-            tf.summary.scalar('loss', self.nme, collections=['train' if self.is_training else 'validate'])
+        self.batch_ne = None
+        self.batch_nme = None
+        self.nme = None
+        self.out_images = None
+        self.features = {}
+        self.distill_loss = None
+        self.loss = None
+        self.exit_predictions = {}
+        self.exit_logits = {}
+        self.exit_loss = None
+        self.early_exit_prediction = None
+        self.exit_index = None
+        self.early_exit_batch_nme = None
+        self.stage_predictions = []
+        self.refine_loss = None
+
+        # Reduced precision keeps float32 master weights; activations run in `dtype`.
+        custom_getter = _float32_variable_getter if self.dtype != tf.float32 else None
+        if not self.trainable:
+            custom_getter = _frozen_variable_getter
+        with tf.variable_scope(name, values=[self.in_mean_shape], reuse=tf.AUTO_REUSE,
+                               custom_getter=custom_getter) as self._scope:
+            with utils.xla_scope(self.use_xla):
+                self._build_network()
+        if not inference_only:
+            self.attach_loss()
+            self.attach_visualization()
+
+    def _summary_collections(self):
+        return ['train' if self.is_training else 'validate']
+
+    def attach_loss(self, shapes=None):
+        """Build the normalized errors and the loss summary.
+        Args:
+            shapes: ground truth [N, num_patches, 2], defaults to the constructor's.
+        Returns:
+            the mean normalized error
+        """
+        if self.nme is not None:
+            return self.nme
+        if shapes is not None:
+            self.in_shapes = shapes
+        with tf.name_scope(self._scope.original_name_scope):
+            with utils.xla_scope(self.use_xla):
+                with tf.name_scope('BatchLoss'):
+                    self.batch_ne = _batch_normalized_error(self.prediction, self.in_shapes, self.num_patches)
+                    self.batch_nme = tf.reduce_mean(self.batch_ne, 1)
+                with tf.name_scope('Loss'):
+                    self.nme = tf.reduce_mean(self.batch_nme)
+            tf.summary.scalar('loss', self.nme, collections=self._summary_collections())
+        return self.nme
+
+    def attach_visualization(self):
+        """Draw ground truth and prediction on the inputs for the image summary."""
+        if self.out_images is not None:
+            return self.out_images
+        with tf.name_scope(self._scope.original_name_scope):
             self.out_images, = tf.py_func(
                 utils.batch_draw_landmarks,
                 [self.in_images, self.in_shapes, self.prediction],
@@ -313,5 +539,288 @@ class MDMModel:
             tf.summary.image(
                 'images', self.out_images,
                 max_outputs=self.batch_size,
-                collections=['train' if self.is_training else 'validate']
+                collections=self._summary_collections()
+            )
+        return self.out_images
+
+    def attach_distillation(self, teacher, weight=0.5, feature_weight=0., feature_names=()):
+        """Build the distillation loss against a frozen teacher MDMModel on the same images.
+        Args:
+            teacher: model whose prediction and features are the targets.
+            weight: weight of the NME against the teacher's prediction; the
+                ground truth NME gets 1 - weight.
+            feature_weight: weight of the squared error of `feature_names` features.
+                Features narrower than the teacher's are widened by a 1x1 conv
+                under the `Distill` variable scope, which is not part of the network.
+            feature_names: keys of `features`.
+        Returns:
+            the total loss
+        """
+        if self.loss is not None:
+            return self.loss
+        nme = self.attach_loss()
+        axis = _channel_axis(self.data_format)
+        with tf.variable_scope('Distill', values=[self.prediction, teacher.prediction], reuse=tf.AUTO_REUSE):
+            with tf.name_scope('Prediction'):
+                self.distill_loss = _normalized_mean_error(
+                    self.prediction, tf.stop_gradient(teacher.prediction), self.num_patches
+                )
+            loss = (1. - weight) * nme + weight * self.distill_loss
+            for name in feature_names:
+                inputs = self.features[name]
+                target = tf.stop_gradient(teacher.features[name])
+                if inputs.shape[axis].value != target.shape[axis].value:
+                    inputs = _conv2d(
+                        inputs, target.shape[axis].value, [1, 1],
+                        data_format=self.data_format,
+                        name=name
+                    )
+                with tf.name_scope('{}Loss'.format(name)):
+                    feature_loss = tf.reduce_mean(
+                        tf.squared_difference(tf.cast(inputs, tf.float32), tf.cast(target, tf.float32))
+                    )
+                tf.summary.scalar('distill_{}'.format(name), feature_loss, collections=self._summary_collections())
+                loss += feature_weight * feature_loss
+            self.loss = tf.identity(loss, name='Loss')
+        tf.summary.scalar('distill_loss', self.distill_loss, collections=self._summary_collections())
+        return self.loss
+
+    def attach_exit_loss(self, weight=0.5, confidence_weight=0.1, tolerance=0.05):
+        """Loss of the early-exit heads, to be added to the main loss.
+        Each exit adds `weight` times its NME and `confidence_weight` times the
+        cross entropy of its confidence against whether its per-sample NME is
+        within `tolerance`.
+        """
+        if self.exit_loss is not None:
+            return self.exit_loss
+        self.attach_loss()
+        with tf.name_scope(self._scope.original_name_scope):
+            with tf.name_scope('ExitLoss'):
+                losses = []
+                for name in self.exits:
+                    batch_nme = tf.reduce_mean(
+                        _batch_normalized_error(self.exit_predictions[name], self.in_shapes, self.num_patches), 1
+                    )
+                    confident = tf.cast(batch_nme <= tolerance, tf.float32)
+                    confidence_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(
+                        labels=confident, logits=self.exit_logits[name]
+                    ))
+                    losses.append(weight * tf.reduce_mean(batch_nme) + confidence_weight * confidence_loss)
+                    tf.summary.scalar('exit_nme_{}'.format(name), tf.reduce_mean(batch_nme),
+                                      collections=self._summary_collections())
+                    tf.summary.scalar('exit_confident_{}'.format(name), tf.reduce_mean(confident),
+                                      collections=self._summary_collections())
+                self.exit_loss = tf.add_n(losses, name='Loss') if losses else tf.constant(0.)
+        return self.exit_loss
+
+    def attach_refine_loss(self, weight=0.5):
+        """`weight` times the NME of the first pass and of every refinement iteration
+        but the last, whose NME is `nme`; to be added to the main loss."""
+        if self.refine_loss is not None:
+            return self.refine_loss
+        self.attach_loss()
+        with tf.name_scope(self._scope.original_name_scope):
+            with tf.name_scope('RefineLoss'):
+                losses = []
+                for i, prediction in enumerate(self.stage_predictions[:-1]):
+                    nme = _normalized_mean_error(prediction, self.in_shapes, self.num_patches)
+                    tf.summary.scalar('refine_nme_{}'.format(i), nme, collections=self._summary_collections())
+                    losses.append(weight * nme)
+                self.refine_loss = tf.add_n(losses, name='Loss') if losses else tf.constant(0.)
+        return self.refine_loss
+
+    def _shuffle_block(self, inputs, *args, **kwargs):
+        """`_shuffle_block` whose inner activations are recomputed in the backward pass
+        instead of kept alive, when training with `recompute`. Only the block input is
+        stored; variable names are unchanged. Recomputed blocks use resource
+        variables, the only ones `@custom_gradient` supports in graph mode."""
+        def block(x):
+            return _shuffle_block(x, *args, **kwargs)
+        if self.recompute and self.is_training:
+            with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+                return tf.contrib.layers.recompute_grad(block)(inputs)
+        return block(inputs)
+
+    def _build_initial(self):
+        with tf.variable_scope('Initial'):
+            inputs = tf.cast(self.in_images, self.dtype)
+            if self.data_format == 'channels_first':
+                inputs = tf.transpose(inputs, [0, 3, 1, 2], name='ToChannelsFirst')
+            inputs = _conv2d(
+                inputs, _INIT_DEPTH, [3, 3],
+                activation=tf.nn.relu,
+                use_bias=False,
+                use_bn=True,
+                training=self.is_training,
+                fold_bn=self.folded,
+                data_format=self.data_format,
+                name='Convolution'
+            )
+            inputs = tf.layers.max_pooling2d(
+                inputs, [2, 2], [2, 2],
+                data_format=self.data_format,
+                name='MaxPooling'
+            )
+        return inputs
+
+    def _build_landmarks(self, inputs, rank=0):
+        """Regress the landmarks from pooled features, in the current variable scope."""
+        with tf.variable_scope('Predict'):
+            # The output is 1x1 spatially, so the reshape is the same in both formats.
+            inputs = _conv2d(
+                inputs, 2 * self.num_patches, [1, 1],
+                data_format=self.data_format,
+                rank=rank,
+                name='Convolution'
+            )
+            inputs = tf.reshape(tf.cast(inputs, tf.float32), [-1, self.num_patches, 2])
+            if self.folded:
+                return tf.identity(inputs, name='add')
+            return inputs + self.in_mean_shape
+
+    def _build_exit(self, inputs, name):
+        """Early-exit head after block `name`: landmarks and the logit of its confidence."""
+        with tf.variable_scope('{}Exit'.format(name)):
+            inputs = _conv2d(
+                inputs, _EXIT_DEPTH, [1, 1],
+                activation=tf.nn.relu,
+                data_format=self.data_format,
+                name='Convolution'
+            )
+            inputs = _global_average_pooling(inputs, self.data_format, name='AvgPooling')
+            logit = _conv2d(
+                inputs, 1, [1, 1],
+                data_format=self.data_format,
+                name='Confidence'
             )
+            return self._build_landmarks(inputs), tf.reshape(tf.cast(logit, tf.float32), [-1])
+
+    def _build_head(self, inputs):
+        with tf.variable_scope('Finalize'):
+            inputs = _conv2d(
+                inputs, 1024, [1, 1],
+                activation=tf.nn.relu,
+                data_format=self.data_format,
+                rank=self.finalize_rank,
+                name='Convolution'
+            )
+            finalize = inputs
+            inputs = tf.layers.dropout(
+                inputs, 0.2,
+                training=self.is_training,
+                name='Dropout'
+            )
+            inputs = _global_average_pooling(inputs, self.data_format, name='AvgPooling')
+        return self._build_landmarks(inputs, self.predict_rank), finalize
+
+    def _build_stages(self, inputs, first=0, threshold=None):
+        """Build ShuffleBlock{first + 1}-3 with their exit heads, then Finalize and Predict.
+        With `threshold`, the stages after an exit are built inside a tf.cond and only
+        run when the exit's confidence is below it for some sample.
+        Returns:
+            (prediction, index in `exits` of the exit taken, len(exits) for Predict)
+        """
+        blocks = [
+            (_INIT_DEPTH, self.depth),
+            (self.depth, 2 * self.depth),
+            (2 * self.depth, 4 * self.depth),
+        ]
+        for index in range(first, len(blocks)):
+            name = 'ShuffleBlock{}'.format(index + 1)
+            in_filters, out_filters = blocks[index]
+            inputs = self._shuffle_block(
+                inputs, in_filters, out_filters, [3, 3], [2, 2], self.block_depths[index],
+                training=self.is_training,
+                fold_bn=self.folded,
+                channel_shuffle=self.channel_shuffle,
+                data_format=self.data_format,
+                name=name
+            )
+            if threshold is None:
+                self.features[name] = inputs
+            if name in self.exits:
+                prediction, logit = self._build_exit(inputs, name)
+                if threshold is None:
+                    self.exit_predictions[name] = prediction
+                    self.exit_logits[name] = logit
+                else:
+                    exit_index = tf.constant(self.exits.index(name))
+                    return tf.cond(
+                        tf.reduce_all(tf.sigmoid(logit) >= threshold),
+                        lambda: (prediction, exit_index),
+                        lambda: self._build_stages(inputs, index + 1, threshold)
+                    )
+        prediction, finalize = self._build_head(inputs)
+        if threshold is None:
+            self.features['Finalize'] = finalize
+        return prediction, tf.constant(len(self.exits))
+
+    def _build_refinement(self, prediction):
+        """Refine `prediction` `refine_iterations` times from sampled features."""
+        features = tf.cast(self.features[self.refine_features], tf.float32)
+        if self.data_format == 'channels_first':
+            features = tf.transpose(features, [0, 2, 3, 1])
+        num_channels = features.shape[-1].value
+        scale = features.shape[1].value / self.in_images.shape[1].value
+        radius = self.refine_patch // 2
+        offsets = tf.constant(
+            [[dy, dx] for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)],
+            tf.float32
+        )
+        self.stage_predictions = [prediction]
+        with tf.variable_scope('Refine'):
+            for _ in range(self.refine_iterations):
+                with tf.variable_scope('Iteration', reuse=tf.AUTO_REUSE):
+                    # Pixel centers to feature cells; the sampling positions get no gradient.
+                    points = (tf.stop_gradient(prediction) + 0.5) * scale - 0.5
+                    points = tf.reshape(
+                        points[:, :, None, :] + offsets, [-1, self.num_patches * self.refine_patch ** 2, 2]
+                    )
+                    inputs = tf.reshape(
+                        _bilinear_sample(features, points),
+                        [-1, self.num_patches, self.refine_patch ** 2 * num_channels]
+                    )
+                    inputs = tf.layers.dense(inputs, _REFINE_ENCODE_DEPTH, tf.nn.relu, name='Encode')
+                    inputs = tf.layers.dense(
+                        tf.reshape(inputs, [-1, self.num_patches * _REFINE_ENCODE_DEPTH]), _REFINE_HIDDEN_DEPTH, tf.nn.relu,
+                        name='Hidden'
+                    )
+                    residual = tf.layers.dense(
+                        inputs, 2 * self.num_patches,
+                        kernel_initializer=tf.zeros_initializer(),
+                        name='Residual'
+                    )
+                    prediction = prediction + tf.reshape(residual, [-1, self.num_patches, 2])
+                    self.stage_predictions.append(prediction)
+            return tf.identity(prediction, name='Prediction')
+
+    def _build_network(self):
+        self.prediction, _ = self._build_stages(self._build_initial())
+        if self.refine_iterations > 0:
+            self.prediction = self._build_refinement(self.prediction)
+
+    def attach_early_exit(self, threshold):
+        """Prediction that stops at the first exit whose confidence reaches `threshold`.
+        The network is rebuilt on the same variables with every stage after an exit
+        inside a tf.cond, so later stages do not run for a batch that exits; export
+        it with batch size 1 for per-request exits.
+        Args:
+            threshold: scalar confidence threshold, may be a placeholder.
+        Returns:
+            (prediction, index in `exits` of the exit taken, len(exits) for Predict);
+            with ground truth shapes, `early_exit_batch_nme` is set too
+        """
+        if self.early_exit_prediction is not None:
+            return self.early_exit_prediction, self.exit_index
+        with tf.variable_scope(self._scope, reuse=True, auxiliary_name_scope=False):
+            with tf.name_scope(self._scope.original_name_scope + 'EarlyExit/'):
+                with utils.xla_scope(self.use_xla):
+                    prediction, exit_index = self._build_stages(self._build_initial(), threshold=threshold)
+                self.early_exit_prediction = tf.identity(prediction, name='Prediction')
+                self.exit_index = tf.identity(exit_index, name='ExitIndex')
+            if self.in_shapes is not None:
+                with tf.name_scope(self._scope.original_name_scope + 'EarlyExitLoss/'):
+                    self.early_exit_batch_nme = _batch_normalized_mean_error(
+                        self.early_exit_prediction, self.in_shapes, self.num_patches
+                    )
+        return self.early_exit_prediction, self.exit_index
@@ -1,23 +1,151 @@
 from datetime import datetime
+import json
 import menpo
 import menpo.io as mio
 import menpo.shape as mshape
 import numpy as np
-import os
 from pathlib import Path
+import random
+import socket
 import tensorflow as tf
 import time
 
+import checkpoint_saver
 import data_provider
+import graph_optimizer
+import hard_example_miner
 import mdm_model
+import moving_average
+import step_timer
+import thread_tuner
 import utils
 
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_string(
+    'benchmark_mode', '',
+    """'input' drains the input pipeline, 'compute' trains on a synthetic on-device batch."""
+)
+tf.flags.DEFINE_integer('benchmark_warmup', 20, """Untimed runs before benchmarking.""")
+tf.flags.DEFINE_integer('benchmark_steps', 200, """Timed runs of the benchmark.""")
 g_config = utils.load_config()
 
 
-def train(scope=''):
-    """Train on dataset for a number of steps."""
+def run_benchmark(sess, fetch, mode):
+    """Time `fetch` and write a JSON summary to `train_dir/benchmark_<mode>.json`."""
+    print('%s: benchmarking %s...' % (datetime.now(), mode))
+    for _ in range(FLAGS.benchmark_warmup):
+        sess.run(fetch)
+    durations = []
+    for _ in range(FLAGS.benchmark_steps):
+        start_time = time.time()
+        sess.run(fetch)
+        durations.append(time.time() - start_time)
+    durations = np.array(durations)
+    summary = {
+        'mode': mode,
+        'host': socket.gethostname(),
+        'date': str(datetime.now()),
+        'batch_size': g_config['batch_size'],
+        'multiplier': g_config['multiplier'],
+        'precision': g_config['precision'],
+        'use_xla': g_config['use_xla'],
+        'train_device': g_config['train_device'],
+        'steps': FLAGS.benchmark_steps,
+        'steps_per_sec': float(1. / np.mean(durations)),
+        'examples_per_sec': float(g_config['batch_size'] / np.mean(durations)),
+        'p50_ms': float(np.percentile(durations, 50) * 1000.),
+        'p90_ms': float(np.percentile(durations, 90) * 1000.),
+    }
+    print(json.dumps(summary, sort_keys=True))
+    train_dir = Path(g_config['train_dir'])
+    if not train_dir.exists():
+        train_dir.mkdir(parents=True)
+    with open(str(train_dir / 'benchmark_{}.json'.format(mode)), 'w') as ofs:
+        json.dump(summary, ofs, indent=4, sort_keys=True)
+    return summary
+
+
+def teacher_saver(teacher_dir, scope='Teacher'):
+    """Saver restoring the frozen teacher under `scope` from the latest `Network`
+    checkpoint in `teacher_dir`, using the moving averages where saved.
+    Returns:
+        (saver, checkpoint path)
+    """
+    ckpt = tf.train.get_checkpoint_state(teacher_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise IOError('No teacher checkpoint found in {}'.format(teacher_dir))
+    saved = {name for name, _ in tf.train.list_variables(ckpt.model_checkpoint_path)}
+    var_list = {}
+    for var in tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope + '/'):
+        name = 'Network' + var.op.name[len(scope):]
+        average = name + '/ExponentialMovingAverage'
+        var_list[average if average in saved else name] = var
+    return tf.train.Saver(var_list), ckpt.model_checkpoint_path
+
+
+def partial_saver(checkpoint_path):
+    """Saver restoring the global variables saved in `checkpoint_path` with the same
+    shape, so a checkpoint of a changed model, e.g. from `low_rank.py`, can be
+    fine-tuned. The others keep their initial values and are listed.
+    """
+    saved = dict(tf.train.list_variables(checkpoint_path))
+    var_list = []
+    for var in tf.global_variables():
+        if saved.get(var.op.name) == var.shape.as_list():
+            var_list.append(var)
+        else:
+            print('%s: %s not restored, %s in checkpoint' % (
+                datetime.now(), var.op.name, saved.get(var.op.name, 'missing')
+            ))
+    return tf.train.Saver(var_list)
+
+
+def read_checkpoint(checkpoint_path):
+    """Values of every variable saved in `checkpoint_path` keyed by name."""
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    return {name: reader.get_tensor(name) for name, _ in tf.train.list_variables(checkpoint_path)}
+
+
+def validation_nme(values, model_config, mean_shape, num_batches, config=None):
+    """Mean validation NME over `num_batches` of an MDMModel built with `model_config`
+    and loaded with `values`."""
+    dataset_base = Path(model_config['train_dataset'].split(':')[0]).parent.parent
+    path_base = data_provider.record_dir(dataset_base, model_config['image_size'])
+    image_size = model_config['image_size']
+    with tf.Graph().as_default() as graph:
+        dataset = data_provider.validate_dataset(
+            path_base, 50, model_config['num_patches'], image_size=image_size
+        )
+        images, shapes = dataset.make_one_shot_iterator().get_next()
+        images.set_shape([50, image_size, image_size, 3])
+        shapes.set_shape([50, model_config['num_patches'], 2])
+        model = mdm_model.MDMModel(
+            images,
+            shapes,
+            tf.constant(mean_shape, dtype=tf.float32),
+            batch_size=50,
+            is_training=False,
+            **mdm_model.config_kwargs(model_config)
+        )
+        with tf.Session(graph=graph, config=config or utils.session_config()) as sess:
+            graph_optimizer.load_variables(sess, values)
+            return float(np.mean([np.mean(sess.run(model.batch_nme)) for _ in range(num_batches)]))
+
+
+def train(scope='', listener=None):
+    """Train on dataset for a number of steps.
+    Args:
+        scope: scope of the batch norm update ops.
+        listener: optional callable (sess, step, validate_model) run after every
+            step; training stops early when it returns True.
+    """
+    utils.set_cpu_affinity(g_config['cpu_affinity'])
+    if g_config['seed'] is not None:
+        random.seed(g_config['seed'])
+        np.random.seed(g_config['seed'])
     with tf.Graph().as_default() as graph, tf.device('/gpu:0'):
+        if g_config['seed'] is not None:
+            tf.set_random_seed(g_config['seed'])
         # Global steps
         tf_global_step = tf.get_variable(
             'GlobalStep', [],
@@ -38,96 +166,75 @@ def train(scope=''):
 
         # Create an optimizer that performs gradient descent.
         opt = tf.train.AdamOptimizer(tf_lr)
+        if g_config['precision'] != 'float32':
+            # Scale the loss so small reduced-precision gradients do not flush to zero;
+            # steps with non-finite gradients are skipped and the scale is lowered.
+            opt = tf.contrib.mixed_precision.LossScaleOptimizer(
+                opt,
+                tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(2 ** 15, 1000)
+            )
 
         data_provider.prepare_images(
             g_config['train_dataset'].split(':'),
-            num_patches=g_config['num_patches'], verbose=True
+            num_patches=g_config['num_patches'],
+            image_size=g_config['image_size'], verbose=True
         )
-        path_base = Path(g_config['train_dataset'].split(':')[0]).parent.parent
-        _mean_shape = mio.import_pickle(path_base / 'mean_shape.pkl')
-        _mean_shape = data_provider.align_reference_shape_to_112(_mean_shape)
+        dataset_base = Path(g_config['train_dataset'].split(':')[0]).parent.parent
+        path_base = data_provider.record_dir(dataset_base, g_config['image_size'])
+        threads = thread_tuner.thread_settings(g_config, path_base)
+        _mean_shape = mio.import_pickle(dataset_base / 'mean_shape.pkl')
+        _mean_shape = data_provider.align_reference_shape_to_size(_mean_shape, g_config['image_size'])
         assert(isinstance(_mean_shape, np.ndarray))
         assert(_mean_shape.shape[0] == g_config['num_patches'])
-        _negatives = []
-        for mp_image in mio.import_images('Dataset/Neg/*.png', verbose=True):
-            _negatives.append(mp_image.pixels.transpose(1, 2, 0).astype(np.float32))
-        _num_negatives = len(_negatives)
+        _negatives = None
+        if g_config['occlusion_probability'] > 0:
+            _negatives = data_provider.load_negatives(
+                g_config['negatives'], size=g_config['image_size'], verbose=True
+            )
 
         tf_mean_shape = tf.constant(_mean_shape, dtype=tf.float32, name='MeanShape')
 
-        def get_random_sample(image, shape):
-            # Occlude
-            _O_AREA = 0.15
-            _O_MIN_H = 0.15
-            _O_MAX_H = 1.0
-            if np.random.rand() < .3:
-                rh = min(112, int((np.random.rand() * (_O_MAX_H - _O_MIN_H) + _O_MIN_H) * 112))
-                rw = min(112, int(12544 * _O_AREA / rh))
-                dy = int(np.random.rand() * (112 - rh))
-                dx = int(np.random.rand() * (112 - rw))
-                idx = int(np.random.rand() * _num_negatives)
-                image[dy:dy+rh, dx:dx+rw] = np.minimum(
-                    1.0,
-                    _negatives[idx][dy:dy+rh, dx:dx+rw]
-                )
-            return image, shape
-
-        def decode_feature_and_augment(serialized):
-            feature = {
-                'train/image': tf.FixedLenFeature([], tf.string),
-                'train/shape': tf.VarLenFeature(tf.float32),
-            }
-            features = tf.parse_single_example(serialized, features=feature)
-            decoded_image = tf.decode_raw(features['train/image'], tf.float32)
-            decoded_image = tf.reshape(decoded_image, (112, 112, 3))
-            decoded_shape = tf.sparse.to_dense(features['train/shape'])
-            decoded_shape = tf.reshape(decoded_shape, (g_config['num_patches'], 2))
-
-            #decoded_image, decoded_shape = tf.py_func(
-            #    get_random_sample, [decoded_image, decoded_shape], [tf.float32, tf.float32],
-            #    stateful=True,
-            #    name='RandomSample'
-            #)
-            return data_provider.distort_color(decoded_image), decoded_shape
-
-        def decode_feature(serialized):
-            feature = {
-                'validate/image': tf.FixedLenFeature([], tf.string),
-                'validate/shape': tf.VarLenFeature(tf.float32),
-            }
-            features = tf.parse_single_example(serialized, features=feature)
-            decoded_image = tf.decode_raw(features['validate/image'], tf.float32)
-            decoded_image = tf.reshape(decoded_image, (112, 112, 3))
-            decoded_shape = tf.sparse.to_dense(features['validate/shape'])
-            decoded_shape = tf.reshape(decoded_shape, (g_config['num_patches'], 2))
-            return decoded_image, decoded_shape
+        miner = None
+        if g_config['ohem']:
+            miner = hard_example_miner.HardExampleMiner(
+                hard_example_miner.num_train_records(path_base),
+                power=g_config['ohem_power'],
+                min_probability=g_config['ohem_min_probability']
+            )
 
         with tf.name_scope('DataProvider'):
-            tf_dataset = tf.data.TFRecordDataset([
-                str(path_base / 'train_0.bin'),
-                str(path_base / 'train_1.bin'),
-                str(path_base / 'train_2.bin'),
-                str(path_base / 'train_3.bin')
-            ])
-            tf_dataset = tf_dataset.repeat()
-            tf_dataset = tf_dataset.map(decode_feature_and_augment, num_parallel_calls=5)
-            tf_dataset = tf_dataset.shuffle(480)
-            tf_dataset = tf_dataset.batch(g_config['batch_size'], True)
-            tf_dataset = tf_dataset.prefetch(1)
-            tf_iterator = tf_dataset.make_one_shot_iterator()
-            tf_images, tf_shapes = tf_iterator.get_next(name='Batch')
-            tf_images.set_shape([g_config['batch_size'], 112, 112, 3])
-            tf_shapes.set_shape([g_config['batch_size'], 75, 2])
-
-            tf_dataset_v = tf.data.TFRecordDataset([str(path_base / 'validate.bin')])
-            tf_dataset_v = tf_dataset_v.repeat()
-            tf_dataset_v = tf_dataset_v.map(decode_feature, num_parallel_calls=5)
-            tf_dataset_v = tf_dataset_v.batch(50, True)
-            tf_dataset_v = tf_dataset_v.prefetch(1)
+            augment, init_feed_dict = data_provider.train_augment(
+                _negatives, g_config['occlusion_probability']
+            )
+            tf_dataset = data_provider.train_dataset(
+                path_base, g_config['batch_size'], g_config['num_patches'],
+                shuffle_buffer=g_config['shuffle_buffer'],
+                augment=augment,
+                keep_probability=miner.tf_keep_probability if miner is not None else None,
+                threadpool_size=threads['private_threadpool_size'],
+                image_size=g_config['image_size'],
+                deterministic=g_config['seed'] is not None
+            )
+            tf_iterator = tf_dataset.make_initializable_iterator()
+            tf_images, tf_shapes, tf_ids = tf_iterator.get_next(name='Batch')
+            tf_images.set_shape([g_config['batch_size'], g_config['image_size'], g_config['image_size'], 3])
+            tf_shapes.set_shape([g_config['batch_size'], g_config['num_patches'], 2])
+
+            if FLAGS.benchmark_mode == 'compute':
+                # No I/O: the model reads a fixed random batch held on the device.
+                with tf.device(g_config['train_device']):
+                    tf_images, tf_shapes, _ = data_provider.synthetic_batch(
+                        g_config['batch_size'], g_config['num_patches'], g_config['image_size']
+                    )
+                tf_ids = tf.fill([g_config['batch_size']], tf.constant(-1, tf.int64))
+
+            tf_dataset_v = data_provider.validate_dataset(
+                path_base, 50, g_config['num_patches'], image_size=g_config['image_size']
+            )
             tf_iterator_v = tf_dataset_v.make_one_shot_iterator()
             tf_images_v, tf_shapes_v = tf_iterator_v.get_next(name='ValidateBatch')
-            tf_images_v.set_shape([50, 112, 112, 3])
-            tf_shapes_v.set_shape([50, 75, 2])
+            tf_images_v.set_shape([50, g_config['image_size'], g_config['image_size'], 3])
+            tf_shapes_v.set_shape([50, g_config['num_patches'], 2])
 
         print('Defining model...')
         with tf.device(g_config['train_device']):
@@ -136,63 +243,153 @@ def train(scope=''):
                 tf_shapes,
                 tf_mean_shape,
                 batch_size=g_config['batch_size'],
-                num_patches=g_config['num_patches'],
-                num_channels=3,
-                multiplier=g_config['multiplier']
+                use_xla=g_config['use_xla'],
+                dtype=g_config['precision'],
+                recompute=g_config['recompute'],
+                **mdm_model.config_kwargs(g_config)
             )
-            tf_grads = opt.compute_gradients(tf_model.nme)
+            tf_loss = tf_model.nme
+            if g_config['teacher_dir']:
+                tf_teacher = mdm_model.MDMModel(
+                    tf_images,
+                    None,
+                    tf_mean_shape,
+                    batch_size=g_config['batch_size'],
+                    num_patches=g_config['num_patches'],
+                    num_channels=3,
+                    multiplier=g_config['teacher_multiplier'],
+                    is_training=False,
+                    use_xla=g_config['use_xla'],
+                    dtype=g_config['precision'],
+                    inference_only=True,
+                    data_format=g_config['data_format'],
+                    block_depths=g_config['teacher_block_depths'],
+                    trainable=False,
+                    name='Teacher'
+                )
+                tf_loss = tf_model.attach_distillation(
+                    tf_teacher,
+                    weight=g_config['distill_weight'],
+                    feature_weight=g_config['distill_feature_weight'],
+                    feature_names=g_config['distill_features']
+                )
+            if g_config['exits']:
+                tf_loss += tf_model.attach_exit_loss(
+                    weight=g_config['exit_weight'],
+                    confidence_weight=g_config['exit_confidence_weight'],
+                    tolerance=g_config['exit_tolerance']
+                )
+            if g_config['refine_iterations'] > 0:
+                tf_loss += tf_model.attach_refine_loss(g_config['refine_weight'])
+            # Collected before the gradients, which re-run the batch norms of recomputed blocks.
+            bn_updates = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope)
+            tf_grads = opt.compute_gradients(tf_loss)
+            if g_config['recompute']:
+                missing = [
+                    var.op.name for grad, var in tf_grads
+                    if grad is None and var.op.name.startswith('Network/ShuffleBlock')
+                ]
+                if missing:
+                    raise ValueError('Recomputed blocks have no gradients for {}'.format(missing))
             with tf.name_scope('Validate'):
                 tf_model_v = mdm_model.MDMModel(
                     tf_images_v,
                     tf_shapes_v,
                     tf_mean_shape,
                     batch_size=50,
-                    num_patches=g_config['num_patches'],
-                    num_channels=3,
-                    multiplier=g_config['multiplier'],
-                    is_training=False
+                    is_training=False,
+                    use_xla=g_config['use_xla'],
+                    dtype=g_config['precision'],
+                    **mdm_model.config_kwargs(g_config)
                 )
         tf.summary.histogram('dx', tf_model.prediction - tf_shapes, collections=['train'])
 
-        bn_updates = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope)
-
         # Add histograms for gradients.
         for grad, var in tf_grads:
             if grad is not None:
                 tf.summary.histogram(var.op.name + '/gradients', grad, collections=['train'])
 
+        # Accumulate the gradients of accumulate_steps micro-batches and apply their mean once,
+        # so the global step, learning rate schedule and EMA advance once per effective batch.
+        num_accumulate = g_config['accumulate_steps']
+        accumulate_op = None
+        if num_accumulate > 1:
+            with tf.name_scope('Accumulate', values=[tf_grads]):
+                accumulators = [
+                    tf.Variable(
+                        tf.zeros(var.shape, dtype=var.dtype.base_dtype),
+                        trainable=False,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        name=var.op.name.replace('/', '_')
+                    )
+                    for grad, var in tf_grads if grad is not None
+                ]
+                tf_grads = [(grad, var) for grad, var in tf_grads if grad is not None]
+                accumulated = [
+                    acc.assign_add(grad / num_accumulate)
+                    for acc, (grad, _) in zip(accumulators, tf_grads)
+                ]
+            tf_grads = [(acc, var) for acc, (_, var) in zip(accumulated, tf_grads)]
+
         # Apply the gradients to adjust the shared variables.
         with tf.name_scope('Optimizer', values=[tf_grads, tf_global_step]):
             apply_gradient_op = opt.apply_gradients(tf_grads, global_step=tf_global_step)
+            if num_accumulate > 1:
+                with tf.control_dependencies([apply_gradient_op]):
+                    apply_gradient_op = tf.group(
+                        *[acc.assign(tf.zeros_like(acc)) for acc in accumulators],
+                        name='ResetAccumulators'
+                    )
 
         # Add histograms for trainable variables.
         for var in tf.trainable_variables():
             tf.summary.histogram(var.op.name, var, collections=['train'])
 
         with tf.name_scope('MovingAverage', values=[tf_global_step]):
-            variable_averages = tf.train.ExponentialMovingAverage(g_config['MOVING_AVERAGE_DECAY'], tf_global_step)
+            variable_averages = moving_average.IntervalMovingAverage(
+                g_config['MOVING_AVERAGE_DECAY'], tf_global_step,
+                interval=g_config['moving_average_interval'],
+                device='/cpu:0' if g_config['moving_average_on_host'] else None
+            )
             variables_to_average = (tf.trainable_variables() + tf.moving_average_variables())
             variables_averages_op = variable_averages.apply(variables_to_average)
 
         # Group all updates to into a single train op.
         bn_updates_op = tf.group(*bn_updates, name='BNGroup')
-        train_op = tf.group(
-            apply_gradient_op, variables_averages_op, bn_updates_op,
-            name='TrainGroup'
-        )
-
-        # Create a saver.
+        if g_config['moving_average_interval'] > 1:
+            # Run on its own every moving_average_interval steps instead.
+            train_op_updates = [apply_gradient_op, bn_updates_op]
+        else:
+            train_op_updates = [apply_gradient_op, variables_averages_op, bn_updates_op]
+        if num_accumulate > 1:
+            # Batch norm statistics follow every micro-batch, weights only the full batch.
+            accumulate_op = tf.group(bn_updates_op, *accumulated, name='AccumulateGroup')
+        train_op = tf.group(*train_op_updates, name='TrainGroup')
+        tf_phase_times = step_timer.phase_timestamps([tf_images, tf_shapes], train_op)
+
+        # Create a saver for restoring and an asynchronous one for saving.
         saver = tf.train.Saver()
+        if g_config['teacher_dir']:
+            tf_teacher_saver, teacher_path = teacher_saver(g_config['teacher_dir'])
+        ckpt_saver = checkpoint_saver.AsyncCheckpointSaver(
+            g_config['train_dir'],
+            keep_latest=g_config['keep_latest'],
+            keep_best=g_config['keep_best'],
+            iterator=tf_iterator if g_config['save_iterator_state'] else None
+        )
 
         train_summary_op = tf.summary.merge_all('train')
         validate_summary_op = tf.summary.merge_all('validate')
 
-        config = tf.ConfigProto(allow_soft_placement=True)
-        config.gpu_options.allow_growth = True
+        config = utils.session_config(threads['intra_op_threads'], threads['inter_op_threads'])
         sess = tf.Session(graph=graph, config=config)
-        init = tf.global_variables_initializer()
+        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
         print('Initializing variables...')
-        sess.run(init)
+        sess.run(init, feed_dict=init_feed_dict)
+        sess.run(tf_iterator.initializer)
+        if g_config['teacher_dir']:
+            tf_teacher_saver.restore(sess, teacher_path)
+            print('%s: Teacher restored from %s' % (datetime.now(), teacher_path))
         print('Initialized variables.')
 
         # Assuming model_checkpoint_path looks something like:
@@ -204,27 +401,63 @@ def train(scope=''):
             saver.restore(sess, ckpt.model_checkpoint_path)
             start_step = int(ckpt.model_checkpoint_path.split('/')[-1].split('-')[-1]) + 1
             print('%s: Restart from %s' % (datetime.now(), g_config['train_dir']))
+            if ckpt_saver.restore_iterator(sess, start_step - 1):
+                print('%s: Input pipeline resumed at step %d' % (datetime.now(), start_step - 1))
         else:
             ckpt = tf.train.get_checkpoint_state(g_config['ckpt_dir'])
             if ckpt and ckpt.model_checkpoint_path:
-                saver.restore(sess, ckpt.model_checkpoint_path)
+                # Only a tool that changed the model on purpose asks for a partial restore.
+                if g_config['partial_restore']:
+                    partial_saver(ckpt.model_checkpoint_path).restore(sess, ckpt.model_checkpoint_path)
+                else:
+                    saver.restore(sess, ckpt.model_checkpoint_path)
                 tf_global_step_op = tf_global_step.assign(0)
                 sess.run(tf_global_step_op)
                 print('%s: Pre-trained model restored from %s' % (datetime.now(), g_config['ckpt_dir']))
 
+        if FLAGS.benchmark_mode == 'input':
+            return run_benchmark(sess, [tf_images, tf_shapes, tf_ids], 'input')
+        elif FLAGS.benchmark_mode == 'compute':
+            return run_benchmark(sess, train_op, 'compute')
+
         train_writer = tf.summary.FileWriter(g_config['train_dir'] + '/train', sess.graph)
         validate_writer = tf.summary.FileWriter(g_config['train_dir'] + '/validate', sess.graph)
 
+        timer = step_timer.StepTimer(graph, window=g_config['timing_window'])
+
         print('Starting training...')
-        steps_per_epoch = 15000 / g_config['batch_size']
+        steps_per_epoch = max(1, 15000 // (g_config['batch_size'] * num_accumulate))
         for step in range(start_step, g_config['max_steps']):
+            validate_loss = None
+            run_options = None
+            run_metadata = None
+            if g_config['trace_steps'] > 0 and step % g_config['trace_steps'] == 0:
+                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                run_metadata = tf.RunMetadata()
+            timer.run_started()
+            start_time = time.time()
+            for _ in range(num_accumulate - 1):
+                _, train_nme, train_ids = sess.run([accumulate_op, tf_model.batch_nme, tf_ids])
+                if miner is not None:
+                    miner.update(train_ids, train_nme)
             if step % steps_per_epoch == 0:
-                start_time = time.time()
-                _, train_loss, train_summary = sess.run([train_op, tf_model.nme, train_summary_op])
+                _, train_loss, train_nme, train_ids, train_summary, phase_times = sess.run(
+                    [train_op, tf_model.nme, tf_model.batch_nme, tf_ids, train_summary_op, tf_phase_times],
+                    options=run_options, run_metadata=run_metadata
+                )
                 duration = time.time() - start_time
+                timer.run_finished(phase_times)
+                if run_metadata is None:
+                    timer.add('summary_step', duration)
+                # Best-k checkpoints are ranked by the mean over validate_batches, not one batch.
+                validate_losses = [sess.run(tf_model_v.nme) for _ in range(g_config['validate_batches'] - 1)]
                 validate_loss, validate_summary = sess.run([tf_model_v.nme, validate_summary_op])
+                validate_loss = float(np.mean(validate_losses + [validate_loss]))
                 train_writer.add_summary(train_summary, step)
                 validate_writer.add_summary(validate_summary, step)
+                validate_writer.add_summary(
+                    tf.Summary(value=[tf.Summary.Value(tag='mean_loss', simple_value=validate_loss)]), step
+                )
 
                 print(
                     '%s: step %d, loss = %.4f (%.3f sec/batch)' % (
@@ -237,21 +470,57 @@ def train(scope=''):
                     )
                 )
             else:
-                start_time = time.time()
-                _, train_loss = sess.run([train_op, tf_model.nme])
+                _, train_loss, train_nme, train_ids, phase_times = sess.run(
+                    [train_op, tf_model.nme, tf_model.batch_nme, tf_ids, tf_phase_times],
+                    options=run_options, run_metadata=run_metadata
+                )
                 duration = time.time() - start_time
+                timer.run_finished(phase_times)
+                if run_metadata is None:
+                    timer.add('step', duration)
                 if step % 100 == 0:
                     print(
                         '%s: step %d, loss = %.4f (%.3f sec/batch)' % (
                             datetime.now(), step, train_loss, duration
                         )
                     )
+                    print('%s: step %d, %s' % (datetime.now(), step, timer.report()))
+
+            # Traced steps are slower than usual and only feed the detailed trace_<phase> breakdown.
+            if run_metadata is not None:
+                timer.add_run_metadata(run_metadata)
+                step_timer.write_chrome_trace(
+                    run_metadata,
+                    str(Path(g_config['train_dir']) / 'timeline_{}.json'.format(step))
+                )
+                train_writer.add_run_metadata(run_metadata, 'step{}'.format(step), step)
 
             assert not np.isnan(train_loss), 'Model diverged with loss = NaN'
 
+            if g_config['moving_average_interval'] > 1 and step % g_config['moving_average_interval'] == 0:
+                sess.run(variables_averages_op)
+
+            if miner is not None:
+                miner.update(train_ids, train_nme)
+                if step % g_config['ohem_refresh_steps'] == 0:
+                    # Trained-on records above the overall mean show the pipeline follows the weights.
+                    sampled, mean = miner.sampled_probability(), miner.probability.mean()
+                    if sampled is not None:
+                        print('%s: step %d, keep probability of trained-on records = %.3f (mean %.3f)' % (
+                            datetime.now(), step, sampled, mean
+                        ))
+                    probability = miner.refresh(sess)
+                    print('%s: step %d, refreshed sampling weights (mean keep probability = %.3f)' % (
+                        datetime.now(), step, probability.mean()
+                    ))
+
             if step % steps_per_epoch == 0 or (step + 1) == g_config['max_steps']:
-                checkpoint_path = os.path.join(g_config['train_dir'], 'model.ckpt')
-                saver.save(sess, checkpoint_path, global_step=step)
+                ckpt_saver.save(sess, step, validate_loss)
+
+            if listener is not None and listener(sess, step, tf_model_v):
+                ckpt_saver.save(sess, step)
+                break
+        ckpt_saver.wait()
 
 
 if __name__ == '__main__':
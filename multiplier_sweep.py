@@ -0,0 +1,136 @@
+"""Width multiplier and block depth sweep: trains every variant for a fixed
+step budget, then measures validation NME and frozen-graph CPU latency and
+prints the latency/accuracy Pareto table.
+
+    python multiplier_sweep.py -c=config.json --multipliers=0.5,1.0,1.5,2.0 --block_depths=4-8-4:2-4-2
+
+With --finetune_dir, each variant starts from the checkpoint in that directory
+('{multiplier}' and '{depths}' are substituted) instead of from scratch.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from datetime import datetime
+import json
+from pathlib import Path
+import tensorflow as tf
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_string('multipliers', '0.5,1.0,1.5,2.0', """Width multipliers, comma separated.""")
+tf.flags.DEFINE_string('block_depths', '4-8-4', """Units of ShuffleBlock1-3, e.g. 4-8-4:2-4-2.""")
+tf.flags.DEFINE_integer('steps', 20000, """Train steps per variant.""")
+tf.flags.DEFINE_integer('validate_batches', 20, """Validate batches averaged for the NME.""")
+tf.flags.DEFINE_string('sweep_dir', 'ckpt/sweep', """Directory of the per-variant train dirs.""")
+tf.flags.DEFINE_string('finetune_dir', '', """Checkpoint directory template to fine-tune from.""")
+tf.flags.DEFINE_float('nme_bar', 0.05, """Validation NME the selected model must reach.""")
+
+import ckpt2pb
+import graph_optimizer
+import mdm_train
+import utils
+
+
+def _depths_name(block_depths):
+    return '-'.join(str(d) for d in block_depths)
+
+
+def run_variant(base_config, multiplier, block_depths, mean_shape):
+    """Train one variant, or load its result if it already finished.
+    Returns:
+        dict with the variant, its validation NME, CPU latency and graph size
+    """
+    name = 'x{}_d{}'.format(multiplier, _depths_name(block_depths))
+    train_dir = Path(FLAGS.sweep_dir) / name
+    result_path = train_dir / 'sweep_result.json'
+    if result_path.exists():
+        with result_path.open('r') as ifs:
+            return json.load(ifs)
+
+    # Without a fine-tune checkpoint train() has nothing to restore and starts from scratch.
+    ckpt_dir = str(train_dir)
+    if FLAGS.finetune_dir:
+        ckpt_dir = FLAGS.finetune_dir.format(multiplier=multiplier, depths=_depths_name(block_depths))
+    variant = dict(
+        base_config,
+        multiplier=multiplier,
+        block_depths=list(block_depths),
+        max_steps=FLAGS.steps,
+        train_dir=str(train_dir),
+        ckpt_dir=ckpt_dir
+    )
+    print('%s: training %s for %d steps...' % (datetime.now(), name, FLAGS.steps))
+    mdm_train.g_config.update(variant)
+    try:
+        mdm_train.train()
+    finally:
+        mdm_train.g_config.update(base_config)
+
+    # Measured on the final checkpoint, which also covers a train_dir already at max_steps.
+    ckpt = tf.train.get_checkpoint_state(str(train_dir))
+    nme = mdm_train.validation_nme(
+        mdm_train.read_checkpoint(ckpt.model_checkpoint_path), variant, mean_shape, FLAGS.validate_batches
+    )
+    _, graph_def = ckpt2pb.freeze_checkpoint(ckpt.model_checkpoint_path, mean_shape, variant)
+    latency = graph_optimizer.measure_latency(
+        graph_def, 'Inputs/InputImage', ckpt2pb.output_name(variant), config=utils.cpu_config()
+    )
+    result = {
+        'name': name,
+        'multiplier': multiplier,
+        'block_depths': list(block_depths),
+        'steps': FLAGS.steps,
+        'nme': nme,
+        'latency_ms': latency['p50_ms'],
+        'pb_bytes': graph_def.ByteSize(),
+    }
+    with result_path.open('w') as ofs:
+        json.dump(result, ofs, indent=4, sort_keys=True)
+    return result
+
+
+def pareto_front(results):
+    """Mark the results no other result beats on both latency and NME."""
+    for result in results:
+        result['pareto'] = not any(
+            other['latency_ms'] <= result['latency_ms'] and other['nme'] <= result['nme']
+            and (other['latency_ms'], other['nme']) != (result['latency_ms'], result['nme'])
+            for other in results
+        )
+    return results
+
+
+def print_table(results):
+    print('{:<16} {:>10} {:>12} {:>8} {:>10} {:>7}'.format(
+        'variant', 'multiplier', 'latency_ms', 'nme', 'pb_kb', 'pareto'
+    ))
+    for result in sorted(results, key=lambda r: r['latency_ms']):
+        print('{:<16} {:>10.2f} {:>12.3f} {:>8.4f} {:>10.1f} {:>7}'.format(
+            result['name'], result['multiplier'], result['latency_ms'], result['nme'],
+            result['pb_bytes'] / 1024., '*' if result['pareto'] else ''
+        ))
+
+
+def main(_):
+    base_config = dict(mdm_train.g_config)
+    mean_shape = ckpt2pb.load_mean_shape()
+    results = []
+    for multiplier in [float(m) for m in FLAGS.multipliers.split(',')]:
+        for depths in FLAGS.block_depths.split(':'):
+            block_depths = [int(d) for d in depths.split('-')]
+            results.append(run_variant(base_config, multiplier, block_depths, mean_shape))
+
+    print_table(pareto_front(results))
+    passing = [r for r in results if r['nme'] <= FLAGS.nme_bar]
+    selected = min(passing, key=lambda r: r['latency_ms']) if passing else None
+    if selected is not None:
+        print('Fastest variant with nme <= {}: {}'.format(FLAGS.nme_bar, selected['name']))
+    else:
+        print('No variant reaches nme <= {}'.format(FLAGS.nme_bar))
+    with open(str(Path(FLAGS.sweep_dir) / 'sweep.json'), 'w') as ofs:
+        json.dump({'results': results, 'nme_bar': FLAGS.nme_bar, 'selected': selected}, ofs,
+                  indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    tf.app.run()
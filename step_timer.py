@@ -0,0 +1,130 @@
+import collections
+import numpy as np
+import tensorflow as tf
+import time
+from tensorflow.python.client import timeline
+
+STEP_PHASES = ('input', 'compute', 'host')
+PHASES = ('input', 'forward', 'backward', 'update', 'summary')
+_SUMMARY_OPS = ('ScalarSummary', 'HistogramSummary', 'ImageSummary', 'MergeSummary', 'PyFunc')
+
+
+def _phase(node_name, op_type):
+    """Map a traced node to the training phase it belongs to."""
+    if op_type in _SUMMARY_OPS:
+        return 'summary'
+    if op_type == 'IteratorGetNext' or node_name.startswith('DataProvider/'):
+        return 'input'
+    if node_name.startswith('gradients/'):
+        return 'backward'
+    if (node_name.startswith('Optimizer/') or node_name.startswith('MovingAverage/')
+            or 'AssignMovingAvg' in node_name or node_name in ('BNGroup', 'TrainGroup')):
+        return 'update'
+    if node_name.startswith('Network/'):
+        return 'forward'
+    return None
+
+
+def _union_length(intervals):
+    total = 0
+    end = None
+    for lo, hi in sorted(intervals):
+        if end is None or lo > end:
+            total += hi - lo
+            end = hi
+        elif hi > end:
+            total += hi - end
+            end = hi
+    return total
+
+
+def phase_breakdown(run_metadata, graph):
+    """Attribute the wall time of a traced step to training phases.
+
+    Ops of one phase that run concurrently are counted once, so every value is
+    the time during which at least one op of that phase was executing.
+    Args:
+        run_metadata: `tf.RunMetadata` of a step run with FULL_TRACE.
+        graph: the graph that was run, used to look up op types.
+    Returns:
+        dict of phase -> seconds
+    """
+    intervals = collections.defaultdict(list)
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        # GPU streams duplicate the kernels already reported for the device.
+        if '/stream:' in dev_stats.device or '/memcpy' in dev_stats.device:
+            continue
+        for node_stats in dev_stats.node_stats:
+            name = node_stats.node_name.split(':')[0]
+            try:
+                op_type = graph.get_operation_by_name(name).type
+            except (KeyError, ValueError):
+                op_type = None
+            phase = _phase(name, op_type)
+            if phase is not None:
+                start = node_stats.all_start_micros
+                intervals[phase].append((start, start + node_stats.all_end_rel_micros))
+    return {phase: _union_length(intervals[phase]) / 1e6 for phase in PHASES}
+
+
+def phase_timestamps(batch, train_op):
+    """Timestamps of the step start, of `batch` being ready and of `train_op` being done.
+    Fetched with every step, they split it into input and compute time without tracing.
+    """
+    with tf.device('/cpu:0'):
+        start = tf.timestamp(name='StepStart')
+        with tf.control_dependencies(batch):
+            input_done = tf.timestamp(name='InputDone')
+        with tf.control_dependencies([train_op]):
+            end = tf.timestamp(name='StepEnd')
+    return start, input_done, end
+
+
+def write_chrome_trace(run_metadata, path):
+    """Dump a traced step as a Chrome trace (chrome://tracing)."""
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(path, 'w') as ofs:
+        ofs.write(trace.generate_chrome_trace_format())
+
+
+class StepTimer:
+    """Rolling window of step times, of the input/compute/host split of every step
+    and of the per-phase times of traced steps, reported as `trace_<phase>`."""
+
+    def __init__(self, graph, window=100):
+        self.graph = graph
+        self._times = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._run_end = None
+
+    def add(self, key, seconds):
+        self._times[key].append(seconds)
+
+    def run_started(self):
+        """Count the time since the previous `run_finished` as host time."""
+        if self._run_end is not None:
+            self.add('host', time.time() - self._run_end)
+
+    def run_finished(self, timestamps):
+        """Add the input and compute time of `phase_timestamps` values."""
+        self._run_end = time.time()
+        start, input_done, end = timestamps
+        self.add('input', input_done - start)
+        self.add('compute', end - input_done)
+
+    def add_run_metadata(self, run_metadata):
+        for phase, seconds in phase_breakdown(run_metadata, self.graph).items():
+            self.add('trace_' + phase, seconds)
+
+    def percentiles(self, key, q=(50, 90, 99)):
+        if len(self._times[key]) == 0:
+            return None
+        return np.percentile(np.array(self._times[key]), q)
+
+    def report(self):
+        """One line of p50/p90/p99 in seconds for every key seen so far."""
+        entries = []
+        for key in ('step', 'summary_step') + STEP_PHASES + tuple('trace_' + p for p in PHASES):
+            p = self.percentiles(key)
+            if p is not None:
+                entries.append('{} {:.3f}/{:.3f}/{:.3f}'.format(key, *p))
+        return 'p50/p90/p99 sec: ' + ', '.join(entries)
@@ -0,0 +1,135 @@
+from datetime import datetime
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import socket
+import tensorflow as tf
+import time
+
+import data_provider
+import mdm_model
+import utils
+
+
+def num_cpus():
+    """CPUs this process may run on, which honours `cpu_affinity`."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def _default_settings(g_config):
+    return {
+        'intra_op_threads': g_config['intra_op_threads'],
+        'inter_op_threads': g_config['inter_op_threads'],
+        'private_threadpool_size': g_config['private_threadpool_size'],
+    }
+
+
+def _load(path):
+    if not Path(path).exists():
+        return {}
+    with open(str(path), 'r') as ifs:
+        return json.load(ifs)
+
+
+def measure(g_config, path_base, settings, negatives=None, num_warmup=10, num_steps=30):
+    """Steps/sec of a forward, backward and Adam step fed by the real train pipeline,
+    augmented as in training, occluding with `negatives` when given.
+    """
+    with tf.Graph().as_default() as graph:
+        with tf.device('/cpu:0'):
+            augment, init_feed_dict = data_provider.train_augment(
+                negatives, g_config['occlusion_probability']
+            )
+            dataset = data_provider.train_dataset(
+                path_base, g_config['batch_size'], g_config['num_patches'],
+                shuffle_buffer=g_config['shuffle_buffer'],
+                augment=augment,
+                threadpool_size=settings['private_threadpool_size'],
+                image_size=g_config['image_size']
+            )
+            iterator = dataset.make_initializable_iterator()
+            images, shapes, _ = iterator.get_next()
+            images.set_shape([g_config['batch_size'], g_config['image_size'], g_config['image_size'], 3])
+            shapes.set_shape([g_config['batch_size'], g_config['num_patches'], 2])
+            mean_shape = tf.reduce_mean(shapes, 0)
+        with tf.device(g_config['train_device']):
+            model = mdm_model.MDMModel(
+                images, shapes, mean_shape,
+                batch_size=g_config['batch_size'],
+                use_xla=g_config['use_xla'],
+                dtype=g_config['precision'],
+                recompute=g_config['recompute'],
+                **mdm_model.config_kwargs(g_config)
+            )
+            with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+                train_op = tf.train.AdamOptimizer(1e-4).minimize(model.nme)
+        config = utils.session_config(settings['intra_op_threads'], settings['inter_op_threads'])
+        with tf.Session(graph=graph, config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer(), feed_dict=init_feed_dict)
+            sess.run(iterator.initializer)
+            for _ in range(num_warmup):
+                sess.run(train_op)
+            start_time = time.time()
+            for _ in range(num_steps):
+                sess.run(train_op)
+            return num_steps / (time.time() - start_time)
+
+
+def tune(g_config, path_base):
+    """Coordinate search of intra-op, inter-op and tf.data threadpool sizes.
+    Each setting is tuned in turn with the others fixed at their best value so
+    far; 0 leaves the choice to TensorFlow.
+    Returns:
+        dict of the best settings and their steps/sec
+    """
+    cpus = num_cpus()
+    powers = [n for n in (1, 2, 4, 8, 16, 32, 64) if n < cpus] + [cpus]
+    search = [
+        ('intra_op_threads', [0] + powers),
+        ('inter_op_threads', [0, 1, 2, 4]),
+        ('private_threadpool_size', [0] + sorted({max(1, cpus // 4), max(1, cpus // 2), cpus})),
+    ]
+    best = {'intra_op_threads': 0, 'inter_op_threads': 0, 'private_threadpool_size': 0}
+    best_speed = None
+    measured = {}
+    negatives = None
+    if g_config['occlusion_probability'] > 0:
+        negatives = data_provider.load_negatives(g_config['negatives'], size=g_config['image_size'])
+    for key, values in search:
+        for value in values:
+            settings = dict(best, **{key: value})
+            signature = tuple(sorted(settings.items()))
+            if signature not in measured:
+                measured[signature] = measure(g_config, path_base, settings, negatives)
+                print('%s: threads %s: %.2f steps/sec' % (datetime.now(), settings, measured[signature]))
+            if best_speed is None or measured[signature] > best_speed:
+                best, best_speed = settings, measured[signature]
+    return dict(best, steps_per_sec=best_speed, cpus=cpus)
+
+
+def thread_settings(g_config, path_base=None):
+    """Thread settings for this host.
+    With `autotune_threads`, returns the settings stored for this host in the
+    `thread_settings` file, or tunes them on the train set under `path_base`
+    and stores them there. Otherwise, or when there is nothing stored and no
+    `path_base` to tune on, returns the config values.
+    """
+    record = _load(g_config['thread_settings'])
+    host = socket.gethostname()
+    if g_config['autotune_threads']:
+        if host in record:
+            return record[host]
+        if path_base is not None:
+            print('%s: tuning thread settings for %s...' % (datetime.now(), host))
+            record[host] = tune(g_config, path_base)
+            if not Path(g_config['thread_settings']).parent.exists():
+                Path(g_config['thread_settings']).parent.mkdir(parents=True)
+            with open(g_config['thread_settings'], 'w') as ofs:
+                json.dump(record, ofs, indent=4, sort_keys=True)
+            print('%s: thread settings %s' % (datetime.now(), record[host]))
+            return record[host]
+    return _default_settings(g_config)
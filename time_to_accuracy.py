@@ -0,0 +1,131 @@
+"""Time-to-accuracy benchmark: wall-clock time and steps `mdm_train.train` needs
+to reach validation NME thresholds.
+
+    python time_to_accuracy.py -c=config.json --seed=42 --thresholds=0.08,0.06,0.05
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from datetime import datetime
+import json
+import numpy as np
+from pathlib import Path
+import resource
+import socket
+import tensorflow as tf
+import time
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_integer('seed', 42, """Graph, NumPy and Python random seed.""")
+tf.flags.DEFINE_string('thresholds', '0.08,0.06,0.05', """Validation NME targets, comma separated.""")
+tf.flags.DEFINE_integer('eval_steps', 500, """Evaluate every this many steps.""")
+tf.flags.DEFINE_integer('validate_batches', 10, """Validate batches averaged per evaluation.""")
+
+import mdm_train
+
+
+class TimeToAccuracy:
+    """`mdm_train.train` listener that evaluates on a schedule and records when
+    each NME threshold is first reached. The clock starts with `start`, before
+    `train` builds the graph, so setup counts; evaluation time is excluded from
+    the train time. Stops training once every threshold is reached."""
+
+    def __init__(self, thresholds, eval_steps, validate_batches, batch_size, train_device):
+        self.thresholds = sorted(thresholds, reverse=True)
+        self.eval_steps = eval_steps
+        self.validate_batches = validate_batches
+        self.batch_size = batch_size
+        self.train_device = train_device
+        self.reached = {}
+        self.history = []
+        self._start_time = None
+        self._start_step = None
+        self._eval_time = 0.
+        self.first_step_time = None
+        self._tf_max_bytes = None
+        self.peak_device_bytes = None
+
+    def start(self):
+        self._start_time = time.time()
+
+    def train_time(self):
+        return time.time() - self._start_time - self._eval_time
+
+    def __call__(self, sess, step, validate_model):
+        if self._start_step is None:
+            # Graph building, initialization, restore and the first step.
+            self.first_step_time = time.time() - self._start_time
+            self._start_step = step
+            if 'gpu' in self.train_device.lower():
+                with tf.device(self.train_device):
+                    self._tf_max_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+        if (step - self._start_step + 1) % self.eval_steps != 0:
+            return False
+
+        eval_start = time.time()
+        nme = np.mean([
+            np.mean(sess.run(validate_model.batch_nme)) for _ in range(self.validate_batches)
+        ])
+        self._eval_time += time.time() - eval_start
+
+        train_time = self.train_time()
+        self.history.append({'step': step, 'nme': float(nme), 'train_time': train_time})
+        print('%s: step %d, validate nme = %.4f (%.1f sec)' % (datetime.now(), step, nme, train_time))
+        for threshold in self.thresholds:
+            if threshold not in self.reached and nme <= threshold:
+                self.reached[threshold] = {
+                    'step': step,
+                    'steps': step - self._start_step + 1,
+                    'train_time': train_time,
+                    'wall_time': time.time() - self._start_time,
+                }
+        if self._tf_max_bytes is not None:
+            self.peak_device_bytes = int(sess.run(self._tf_max_bytes))
+        return len(self.reached) == len(self.thresholds)
+
+    def summary(self, g_config):
+        steps = self.history[-1]['step'] - self._start_step + 1 if self.history else 0
+        train_time = self.train_time() if self._start_time is not None else 0.
+        # Throughput after the first step, which also holds the setup.
+        steady_time = train_time - (self.first_step_time or 0.)
+        return {
+            'host': socket.gethostname(),
+            'date': str(datetime.now()),
+            'seed': g_config['seed'],
+            'batch_size': self.batch_size,
+            'multiplier': g_config['multiplier'],
+            'precision': g_config['precision'],
+            'thresholds': {
+                '{:.4f}'.format(t): self.reached.get(t) for t in self.thresholds
+            },
+            'steps': steps,
+            'train_time': train_time,
+            'first_step_time': self.first_step_time,
+            'examples_per_sec': (steps - 1) * self.batch_size / steady_time if steps > 1 and steady_time > 0 else None,
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'peak_device_bytes': self.peak_device_bytes,
+            'history': self.history,
+        }
+
+
+def main(_):
+    g_config = mdm_train.g_config
+    g_config['seed'] = FLAGS.seed
+    listener = TimeToAccuracy(
+        [float(t) for t in FLAGS.thresholds.split(',')],
+        FLAGS.eval_steps,
+        FLAGS.validate_batches,
+        g_config['batch_size'] * g_config['accumulate_steps'],
+        g_config['train_device']
+    )
+    listener.start()
+    mdm_train.train(listener=listener)
+    summary = listener.summary(g_config)
+    print(json.dumps(summary, sort_keys=True))
+    with open(str(Path(g_config['train_dir']) / 'time_to_accuracy.json'), 'w') as ofs:
+        json.dump(summary, ofs, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    tf.app.run()
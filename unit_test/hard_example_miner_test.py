@@ -0,0 +1,33 @@
+import numpy as np
+import sys
+sys.path.append('..')
+
+from hard_example_miner import *
+
+# =====Refresh reaches the pipeline test=====
+print('Testing HardExampleMiner.refresh() ...')
+num_records = 1000
+with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+    miner = HardExampleMiner(num_records, min_probability=0.)
+    dataset = tf.data.Dataset.range(num_records).repeat()
+    dataset = dataset.filter(
+        lambda record_id: tf.random_uniform([]) < tf.gather(miner.tf_keep_probability, record_id)
+    )
+    dataset = dataset.batch(100)
+    iterator = dataset.make_initializable_iterator()
+    tf_ids = iterator.get_next()
+    sess.run(tf.local_variables_initializer())
+    sess.run(iterator.initializer)
+
+    ids = np.concatenate([sess.run(tf_ids) for _ in range(20)])
+    assert np.mean(ids < num_records // 2) > 0.4
+
+    # Only the first half is hard; the iterator is not re-initialized.
+    miner.update(np.arange(num_records), np.where(np.arange(num_records) < num_records // 2, 1., 0.))
+    probability = miner.refresh(sess)
+    assert np.all(probability[num_records // 2:] == 0.)
+    ids = np.concatenate([sess.run(tf_ids) for _ in range(20)])
+    assert np.all(ids < num_records // 2), 'the pipeline still samples with the old keep probabilities'
+    miner.update(ids, np.ones(len(ids), dtype=np.float32))
+    assert miner.sampled_probability() > probability.mean()
+print('Tested HardExampleMiner.refresh()')
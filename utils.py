@@ -1,8 +1,10 @@
+import contextlib
 import cv2
 import json
 import menpo.image as mimage
 import menpo.shape as mshape
 import numpy as np
+import os
 import tensorflow as tf
 
 # ===== 68 =====
@@ -112,6 +114,52 @@ def mirror_image(image):
     return image
 
 
+# =====Session=====
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    """Session config shared by training and evaluation; 0 threads lets TensorFlow decide."""
+    config = tf.ConfigProto(
+        allow_soft_placement=True,
+        intra_op_parallelism_threads=intra_op_threads,
+        inter_op_parallelism_threads=inter_op_threads
+    )
+    config.gpu_options.allow_growth = True
+    return config
+
+
+def cpu_config():
+    """`session_config` without GPUs, for latency and NME comparisons on the CPU."""
+    config = session_config()
+    config.device_count['GPU'] = 0
+    return config
+
+
+def set_cpu_affinity(cpus):
+    """Pin this process, and the threads and processes it starts later, to `cpus`.
+    Args:
+        cpus: list string such as '0-7,16-23', empty to leave affinity unchanged.
+    """
+    if not cpus:
+        return
+    cpu_set = set()
+    for part in cpus.split(','):
+        lo, _, hi = part.partition('-')
+        cpu_set.update(range(int(lo), int(hi or lo) + 1))
+    os.sched_setaffinity(0, cpu_set)
+
+
+# =====XLA=====
+@contextlib.contextmanager
+def _no_scope():
+    yield
+
+
+def xla_scope(enabled):
+    """Scope whose ops (and their gradients) are JIT-compiled by XLA when enabled."""
+    if enabled:
+        return tf.contrib.compiler.jit.experimental_jit_scope()
+    return _no_scope()
+
+
 # =====Plot=====
 def draw_landmarks(image, ground_truth, prediction):
     image = image.copy()
@@ -131,7 +179,18 @@ def batch_draw_landmarks(images, ground_truths, predictions):
 
 
 # =====Config=====
+_g_config = None
+
+
 def load_config():
+    """Load and confirm the config once; modules importing it share the same dict.
+    Reading `FLAGS.c` parses the command line, so a tool importing a module that
+    loads the config at import (mdm_train, mdm_eval, ckpt2pb) must define its own
+    flags before that import.
+    """
+    global _g_config
+    if _g_config is not None:
+        return _g_config
     if 'c' not in tf.flags.FLAGS:
         tf.flags.DEFINE_string('c', 'config.json', """Model config file""")
     with open(tf.flags.FLAGS.c, 'r') as g_config:
@@ -140,4 +199,6 @@ def load_config():
         print('%s:' % k, g_config[k], type(g_config[k]))
     assert isinstance(g_config, dict)
     res = input('OK?(Y/N): ')
-    return g_config if res == 'y' or res == 'Y' else None
+    if res == 'y' or res == 'Y':
+        _g_config = g_config
+    return _g_config